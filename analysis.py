@@ -0,0 +1,287 @@
+import pandas as pd
+import numpy as np
+import pyarrow.dataset as ds
+import os
+
+"""Streaming versions of the standard waiting time aggregations from analyzing_simulation_output.ipynb
+
+The passenger outputs of every scenario (ex. output/d12k ... output/d20k) are read as pyarrow datasets one record batch
+at a time, only reading the columns that are needed and pushing filters down to the parquet reader, so comparing
+scenarios never needs all the passenger rows in memory at once.
+
+Means come from running sums. Medians are exact: histogram passes over the data narrow each group's median down to a
+small range of candidate values, and only those candidates are kept and partially sorted (np.partition)
+"""
+
+#group keys are replication * HOUR_SLOTS + arrival_hour, arrival hours are always < HOUR_SLOTS
+HOUR_SLOTS = 32
+
+def open_scenarios(folders, output_dir = 'output', file_name = 'passenger_parquet'):
+    """Opens the passenger outputs of several simulation runs as {scenario name: pyarrow dataset}
+
+       folders = list of folder names in output_dir (the folder name is used as the scenario name)
+                 or a dictionary of scenario name: path to a parquet file/directory
+    """
+    if not isinstance(folders, dict):
+        folders = {f: os.path.join(output_dir, f, file_name) for f in folders}
+    return {name: ds.dataset(path, format = 'parquet') for name, path in folders.items()}
+
+def open_sweep(sweep_dir):
+    """Opens the partitioned passenger dataset written by sweep.run_sweep as {scenario name: pyarrow dataset}"""
+    passengers_dir = os.path.join(sweep_dir, 'passengers')
+    partitions = sorted(p for p in os.listdir(passengers_dir) if p.startswith('scenario='))
+    return {p[len('scenario='):]: ds.dataset(os.path.join(passengers_dir, p), format = 'parquet') for p in partitions}
+
+def scan_groups(dataset, value = 'waiting_time', by_hour = False, filter = None, batch_size = 1 << 18):
+    """Yields (group keys, values) for every record batch of the dataset, rows with a missing value are skipped"""
+    columns = [value, 'replication'] + (['arrival_hour'] if by_hour else [])
+    for batch in dataset.to_batches(columns = columns, filter = filter, batch_size = batch_size):
+        if batch.num_rows == 0:
+            continue
+        values = batch.column(0).to_numpy(zero_copy_only = False).astype(float)
+        keys = batch.column(1).to_numpy(zero_copy_only = False).astype(np.int64) * HOUR_SLOTS
+        if by_hour:
+            keys = keys + batch.column(2).to_numpy(zero_copy_only = False).astype(np.int64)
+        valid = ~np.isnan(values)
+        yield keys[valid], values[valid]
+
+def group_moments(scan):
+    """One pass over the data, returns (sorted group keys, counts, sums, mins, maxs)"""
+    partials = []
+    for keys, values in scan():
+        batch_keys, inverse = np.unique(keys, return_inverse = True)
+        mins = np.full(len(batch_keys), np.inf)
+        maxs = np.full(len(batch_keys), -np.inf)
+        np.minimum.at(mins, inverse, values)
+        np.maximum.at(maxs, inverse, values)
+        partials.append((batch_keys, np.bincount(inverse), np.bincount(inverse, weights = values), mins, maxs))
+    if len(partials) == 0:
+        return tuple(np.array([]) for i in range(5))
+
+    #combine the per batch partial aggregates
+    all_keys = np.concatenate([p[0] for p in partials])
+    group_keys, inverse = np.unique(all_keys, return_inverse = True)
+    counts = np.zeros(len(group_keys), dtype = np.int64)
+    sums = np.zeros(len(group_keys))
+    mins = np.full(len(group_keys), np.inf)
+    maxs = np.full(len(group_keys), -np.inf)
+    np.add.at(counts, inverse, np.concatenate([p[1] for p in partials]))
+    np.add.at(sums, inverse, np.concatenate([p[2] for p in partials]))
+    np.minimum.at(mins, inverse, np.concatenate([p[3] for p in partials]))
+    np.maximum.at(maxs, inverse, np.concatenate([p[4] for p in partials]))
+    return group_keys, counts, sums, mins, maxs
+
+def group_medians(scan, group_keys, counts, mins, maxs, bins = 1024, max_candidates = 1 << 16, max_refinements = 8):
+    """Exact medians per group, needs the output of group_moments and re-reads the data a few times
+
+    Every group keeps a value range [low, high) that is known to contain its median, plus the ranks of the median
+    within that range. Each histogram pass splits the range into bins and keeps only the bin(s) holding the median,
+    until few enough values are left to collect them and np.partition them. A bin whose values are all equal (its min
+    and max match) gives the value of the median rank inside it directly, so tied values are counted, never collected
+    """
+    g_count = len(group_keys)
+    low, high = mins.astype(float), maxs.astype(float)
+    high_inclusive = np.ones(g_count, dtype = bool)
+    rank_low, rank_high = (counts - 1) // 2, counts // 2
+    candidates = counts.copy()
+
+    #values at rank_low/rank_high once they're known (nan until then)
+    value_low = np.full(g_count, np.nan)
+    value_high = np.full(g_count, np.nan)
+    single = (counts > 0) & (low == high)
+    value_low[single], value_high[single] = low[single], low[single]
+
+    def resolve(g):
+        #nothing left to collect, an empty range matches no value
+        candidates[g] = 0
+        low[g], high[g] = np.nan, np.nan
+
+    for g in np.flatnonzero(single):
+        resolve(g)
+
+    def in_range(g, values):
+        return (values >= low[g]) & ((values < high[g]) | (high_inclusive[g] & (values == high[g])))
+
+    def edge(g, b):
+        return np.where(b == bins, high[g], low[g] + b * (high[g] - low[g]) / bins)
+
+    for i in range(max_refinements):
+        refine = (candidates > max_candidates) & (high > low)
+        if not refine.any():
+            break
+
+        hist = np.zeros(g_count * bins, dtype = np.int64)
+        bin_min = np.full(g_count * bins, np.inf)
+        bin_max = np.full(g_count * bins, -np.inf)
+        for keys, values in scan():
+            g = np.searchsorted(group_keys, keys)
+            keep = refine[g] & in_range(g, values)
+            g, values = g[keep], values[keep]
+            b = np.clip(((values - low[g]) / (high[g] - low[g]) * bins).astype(np.int64), 0, bins - 1)
+            #floating point can put a value one bin off, line the bins up exactly with edge()
+            b = b - (values < edge(g, b))
+            b = b + ((b < bins - 1) & (values >= edge(g, b + 1)))
+            hist += np.bincount(g * bins + b, minlength = g_count * bins)
+            np.minimum.at(bin_min, g * bins + b, values)
+            np.maximum.at(bin_max, g * bins + b, values)
+
+        for g in np.flatnonzero(refine):
+            cumulative = hist[g * bins:(g + 1) * bins].cumsum()
+            b_low = np.searchsorted(cumulative, rank_low[g], side = 'right')
+            b_high = np.searchsorted(cumulative, rank_high[g], side = 'right')
+
+            #ranks that fall in a bin of tied values are done
+            for b, value in [(b_low, value_low), (b_high, value_high)]:
+                if np.isnan(value[g]) and bin_min[g * bins + b] == bin_max[g * bins + b]:
+                    value[g] = bin_min[g * bins + b]
+            if not np.isnan(value_low[g]) and not np.isnan(value_high[g]):
+                resolve(g)
+                continue
+            #only keep the bin of the rank that's still unknown
+            if not np.isnan(value_low[g]):
+                b_low, rank_low[g] = b_high, rank_high[g]
+            elif not np.isnan(value_high[g]):
+                b_high, rank_high[g] = b_low, rank_low[g]
+            before = cumulative[b_low - 1] if b_low > 0 else 0
+
+            new_low, new_high = edge(g, b_low), edge(g, b_high + 1)
+            high_inclusive[g] = high_inclusive[g] and b_high == bins - 1
+            low[g], high[g] = new_low, new_high
+            rank_low[g] -= before
+            rank_high[g] -= before
+            candidates[g] = cumulative[b_high] - before
+
+    #collect the remaining candidates of every group and partially sort them
+    collected = [[] for g in range(g_count)]
+    for keys, values in scan():
+        g = np.searchsorted(group_keys, keys)
+        keep = in_range(g, values)
+        g, values = g[keep], values[keep]
+        order = np.argsort(g, kind = 'stable')
+        g, values = g[order], values[order]
+        splits = np.flatnonzero(np.diff(g)) + 1
+        for start, end in zip(np.r_[0, splits], np.r_[splits, len(g)]):
+            if end > start:
+                collected[g[start]].append(values[start:end])
+
+    for g in range(g_count):
+        if counts[g] == 0 or candidates[g] == 0:
+            continue
+        values = np.partition(np.concatenate(collected[g]), [rank_low[g], rank_high[g]])
+        if np.isnan(value_low[g]):
+            value_low[g] = values[rank_low[g]]
+        if np.isnan(value_high[g]):
+            value_high[g] = values[rank_high[g]]
+    return (value_low + value_high) / 2
+
+def aggregate_waiting_times(folders, value = 'waiting_time', by_hour = False, filter = None, output_dir = 'output', **median_options):
+    """count, mean and median of value per (scenario, replication) or per (scenario, replication, arrival_hour)
+
+       folders = see open_scenarios (or an already opened {scenario: dataset} dictionary)
+       filter = optional pyarrow expression pushed down to the reader, ex. ds.field('arrival_hour') >= 6
+    """
+    if isinstance(folders, dict) and all(isinstance(d, ds.Dataset) for d in folders.values()):
+        datasets = folders
+    else:
+        datasets = open_scenarios(folders, output_dir)
+
+    results = []
+    for scenario, dataset in datasets.items():
+        scan = lambda: scan_groups(dataset, value, by_hour, filter)
+        group_keys, counts, sums, mins, maxs = group_moments(scan)
+        medians = group_medians(scan, group_keys, counts, mins, maxs, **median_options)
+
+        result = pd.DataFrame({'scenario': scenario,
+                               'replication': group_keys // HOUR_SLOTS,
+                               'count': counts,
+                               'mean': sums / counts,
+                               'median': medians})
+        if by_hour:
+            result.insert(2, 'arrival_hour', group_keys % HOUR_SLOTS)
+        results.append(result)
+    return pd.concat(results, ignore_index = True)
+
+def summarize_replications(aggregated):
+    """Mean and variance across replications of the per replication means and medians (what the notebook compares)"""
+    group_columns = ['scenario'] + (['arrival_hour'] if 'arrival_hour' in aggregated.columns else [])
+    summary = aggregated.groupby(group_columns)[['mean', 'median']].agg(['mean', 'var'])
+    summary.columns = [f'{statistic}_{over_replications}' for statistic, over_replications in summary.columns]
+    summary['replications'] = aggregated.groupby(group_columns).replication.nunique()
+    return summary.reset_index()
+
+"""Fleet state time series: how many drivers are idle, deadheading (moving without a passenger) or carrying a passenger
+in every zone at every minute, rebuilt from the movement histories of the simulated Drivers (driver_segments)
+
+Every segment adds +1 at the first minute it covers and -1 at the first minute after it in a (minute, zone, state)
+difference array (np.add.at), and a cumulative sum over the minutes gives the counts, so the cost is linear in the #
+of segments no matter how long they are
+
+driver_histories_parquet can't be used as the input: its histories start with an idle segment at time 0 whatever the
+driver's shift, drivers that never moved have no rows and there's no idle segment after the last movement, so off
+shift drivers would be counted as idle and idle drivers would be missing
+"""
+FLEET_STATES = ['idle', 'deadheading', 'with_passenger']
+SEGMENT_COLUMNS = ['start_time', 'end_time', 'start_zone', 'end_zone', 'is_moving', 'has_passenger']
+
+def driver_segments(drivers, day_length = 1440):
+    """Movement histories of a list of Drivers as a dictionary of arrays (SEGMENT_COLUMNS)
+
+    Histories start at time 0 whatever the driver's schedule, so idle segments are cut down to the driver's shift,
+    and every driver gets a last idle segment from its last movement to the end of the day (also cut to the shift)
+    """
+    rows = [h[:6] for d in drivers for h in d.movement_history]
+    rows.extend((d.last_time, day_length, d.last_location, d.last_location, False, False) for d in drivers)
+    segments = np.array(rows, dtype = float).reshape((-1, 6))
+    #shift of every row, the last idle segments come after all the histories
+    history_lengths = [len(d.movement_history) for d in drivers]
+    shift_start = np.r_[np.repeat([d.start for d in drivers], history_lengths), [d.start for d in drivers]].astype(float)
+    shift_end = np.r_[np.repeat([d.end for d in drivers], history_lengths), [d.end for d in drivers]].astype(float)
+
+    moving = segments[:, 4] == 1
+    #shifts wrapping around midnight (start > end) are [0, end] + [start, end of day]
+    wrap = shift_start > shift_end
+    pieces = [segments[moving],
+              np.c_[np.maximum(segments[:, 0], np.where(wrap, 0, shift_start)), np.minimum(segments[:, 1], shift_end), segments[:, 2:]][~moving],
+              np.c_[np.maximum(segments[:, 0], shift_start), segments[:, 1], segments[:, 2:]][~moving & wrap]]
+    segments = np.concatenate(pieces)
+    segments = segments[segments[:, 1] > segments[:, 0]]
+    return {c: segments[:, i] for i, c in enumerate(SEGMENT_COLUMNS)}
+
+def segment_arrays(segments):
+    """SEGMENT_COLUMNS as numpy arrays from a dataframe, a pyarrow table/record batch or a dictionary of arrays"""
+    if hasattr(segments, 'column_names'):
+        return {c: segments.column(c).to_numpy(zero_copy_only = False) for c in SEGMENT_COLUMNS}
+    return {c: np.asarray(segments[c]) for c in SEGMENT_COLUMNS}
+
+def fleet_state_tensor(segments, zones = 263, minutes = 1440, moving_zone = 'start'):
+    """array(minutes, zones, 3) of the # of drivers in each FLEET_STATES state at the start of every minute per zone
+       (zone positions are zone_id - 1)
+
+       segments = driver_segments(drivers), or the same columns as a dataframe/pyarrow table (see segment_arrays)
+       moving_zone = 'start' counts a moving driver in the zone it left, 'end' in the zone it's going to
+    """
+    s = segment_arrays(segments)
+    #a segment covers the minutes m with start_time <= m < end_time
+    first = np.clip(np.ceil(s['start_time']), 0, minutes).astype(np.int64)
+    last = np.clip(np.ceil(s['end_time']), 0, minutes).astype(np.int64)
+    zone = s['start_zone' if moving_zone == 'start' else 'end_zone'].astype(np.int64) - 1
+    moving = s['is_moving'].astype(bool)
+    state = np.where(moving, np.where(s['has_passenger'].astype(bool), 2, 1), 0)
+    #idle drivers stay where they are
+    zone = np.where(moving, zone, s['start_zone'].astype(np.int64) - 1)
+
+    covers = last > first
+    differences = np.zeros((minutes + 1, zones, len(FLEET_STATES)), dtype = np.int64)
+    np.add.at(differences, (first[covers], zone[covers], state[covers]), 1)
+    np.add.at(differences, (last[covers], zone[covers], state[covers]), -1)
+    return differences[:minutes].cumsum(axis = 0)
+
+def accumulate_fleet_states(batches, zones = 263, minutes = 1440, moving_zone = 'start'):
+    """Sum of fleet_state_tensor over an iterable of segment batches, only one batch is in memory at a time
+
+       ex. one driver_segments(drivers) per replication, divide by the # of replications for the average day
+    """
+    total = np.zeros((minutes, zones, len(FLEET_STATES)), dtype = np.int64)
+    for batch in batches:
+        total += fleet_state_tensor(batch, zones, minutes, moving_zone)
+    return total
@@ -0,0 +1,238 @@
+import pandas as pd
+import numpy as np
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from simulation import *
+from DriverAnimation import DriverAnimation
+
+"""Benchmarks for the hot paths of the simulator, run fully offline against synthetic cities
+
+The synthetic inputs have the same shapes as the real ones (hourly arrival rates per zone, dropoff frequencies,
+trip_time_means with a (pulocationid, dolocationid) index and mean/std/min/max/count columns), so zone count,
+fleet size and demand can be scaled independently of the real data.
+
+'python3 benchmarks.py --zones 263 --drivers 12000 --arrivals 450000' writes the timings to bench_results/ as JSON,
+'python3 benchmarks.py compare OLD.json NEW.json' prints the change between two result files
+"""
+
+def synthetic_inputs(zones = 263, arrivals_per_day = 450000, missing_pairs = 0.3, seed = 0):
+    """Returns (hourly arrival rates, dropoff frequencies, trip time data) for a random city of zones 1, ..., zones"""
+    rng = np.random.default_rng(seed)
+    zone_ids = np.arange(1, zones + 1)
+
+    #zones are points in a 20 x 20 (km) square, with very uneven demand like the real city
+    positions = rng.uniform(0, 20, size = (zones, 2))
+    weights = rng.lognormal(sigma = 1.5, size = zones)
+    weights = weights / weights.sum()
+
+    #demand peaks in the evening and is lowest early in the morning
+    hours = np.arange(24)
+    profile = 1 + 0.7 * np.sin((hours - 12) / 24 * 2 * np.pi)
+    profile = profile / profile.sum()
+    hourly_rates = pd.DataFrame(arrivals_per_day * np.outer(weights, profile),
+                                index = pd.Index(zone_ids, name = 'pulocationid'))
+
+    #trips are more likely to go to nearby, busy zones
+    distances = np.sqrt(((positions[:, None, :] - positions[None, :, :]) ** 2).sum(axis = 2))
+    attraction = weights[None, :] * np.exp(-distances / 5)
+    dropoff_frequency = pd.DataFrame(attraction / attraction.sum(axis = 1, keepdims = True),
+                                     index = hourly_rates.index, columns = zone_ids)
+
+    #trip times grow with distance, some pairs are never observed (all zeros, like sparse zones in the real data)
+    means = 4 + 2.5 * distances * rng.uniform(0.8, 1.2, size = distances.shape)
+    observed = rng.uniform(size = distances.shape) >= missing_pairs
+    np.fill_diagonal(observed, True)
+    stats = np.stack([means, 0.25 * means, 0.5 * means, 2.5 * means, rng.poisson(50, size = distances.shape) + 1], axis = 2)
+    stats = stats * observed[:, :, None]
+    index = pd.MultiIndex.from_product([zone_ids, zone_ids], names = ['pulocationid', None])
+    trip_time_data = pd.DataFrame(stats.reshape((-1, 5)), index = index, columns = OD_COLUMNS)
+
+    return hourly_rates, dropoff_frequency, trip_time_data
+
+def time_it(function, repeat = 3, setup = None):
+    """Runs setup (untimed) then function repeat times, returns the list of durations in seconds"""
+    durations = []
+    for i in range(repeat):
+        arguments = setup() if setup is not None else ()
+        tic = time.perf_counter()
+        function(*arguments)
+        durations.append(time.perf_counter() - tic)
+    return durations
+
+def result(durations, operations = 1):
+    best = min(durations)
+    return {'seconds': durations, 'best': best, 'operations': operations, 'best_per_operation_us': best / operations * 1e6}
+
+def bench_event_list(events = 200000, repeat = 3, seed = 0):
+    rng = np.random.default_rng(seed)
+    initial = [Event(t, 'Arrival') for t in rng.uniform(0, 1440, size = events)]
+    inserted = [Event(t, 'Movement') for t in rng.uniform(0, 1440, size = events // 10)]
+
+    def insert(event_list):
+        for e in inserted:
+            event_list.insert_event(e)
+
+    def pop(event_list):
+        while not event_list.is_finished():
+            event_list.iterate_next_event()
+
+    def filled_event_list():
+        event_list = EventList(initial)
+        insert(event_list)
+        return (event_list,)
+
+    def reschedule(event_list):
+        for e, t in zip(inserted, new_times):
+            event_list.reschedule(e, t)
+
+    new_times = rng.uniform(0, 1440, size = len(inserted))
+    return {'event_list_insert': result(time_it(insert, repeat, lambda: (EventList(initial),)), len(inserted)),
+            'event_list_pop': result(time_it(pop, repeat, filled_event_list), len(initial) + len(inserted)),
+            'event_list_reschedule': result(time_it(reschedule, repeat, filled_event_list), len(inserted))}
+
+def bench_city_dispatch(inputs, drivers = 12000, arrivals = 20000, repeat = 3, seed = 0):
+    hourly_rates, dropoff_frequency, trip_time_data = inputs
+    rng = np.random.default_rng(seed)
+    zone_ids = hourly_rates.index.values
+    pickups = rng.choice(zone_ids, size = arrivals, p = hourly_rates.sum(axis = 1) / hourly_rates.values.sum())
+    arrival_data = np.c_[np.sort(rng.uniform(0, 1440, size = arrivals)), pickups, rng.choice(zone_ids, size = arrivals), rng.uniform(5, 30, size = arrivals)]
+
+    def setup():
+        #every driver starts free (end < start) in a random zone
+        fleet = [Driver(z, 1, 0, driver_id = i) for i, z in enumerate(rng.choice(zone_ids, size = drivers))]
+        passengers = PassengerTable(arrival_data)
+        city = City('Synthetic', zone_ids, fleet, trip_time_data, passengers, rng = seed)
+        return city, [Arrival(passengers.time[i], i) for i in range(arrivals)]
+
+    def dispatch(city, events):
+        for e in events:
+            city.process_arrival_event(e)
+
+    tic = time.perf_counter()
+    setup()
+    city_setup = time.perf_counter() - tic
+    return {'city_init': result([city_setup]),
+            'city_process_arrival_event': result(time_it(dispatch, repeat, setup), arrivals)}
+
+def bench_generate_arrivals(inputs, repeat = 3, seed = 0):
+    hourly_rates, dropoff_frequency, trip_time_data = inputs
+    arrival_counts = []
+    def generate(rng):
+        arrival_counts.append(len(generate_arrivals_per_zone(hourly_rates, dropoff_frequency, trip_time_data, rng = rng)))
+    durations = time_it(generate, repeat, lambda: (np.random.default_rng(seed),))
+    return {'generate_arrivals_per_zone': result(durations, arrival_counts[-1])}
+
+def bench_driver_schedules(drivers = 12000, repeat = 3, seed = 0):
+    schedule_counts = []
+    def generate(rng):
+        schedule_counts.append(len(generate_driver_schedules(np.full(1440, drivers), rng = rng)))
+    durations = time_it(generate, repeat, lambda: (np.random.default_rng(seed),))
+    return {'generate_driver_schedules': result(durations, schedule_counts[-1])}
+
+def bench_simulation_day(inputs, drivers = 12000, seed = 0):
+    hourly_rates, dropoff_frequency, trip_time_data = inputs
+    streams = replication_streams(seed, 0)
+    arrivals = generate_arrivals_per_zone(hourly_rates, dropoff_frequency, trip_time_data, rng = streams['demand'])
+
+    tic = time.perf_counter()
+    passengers, fleet, city, event_list = simulate_with_individual_drivers(arrivals, drivers,
+                                                                          odmatrix = trip_time_data,
+                                                                          pickup_data = hourly_rates,
+                                                                          supply_rng = streams['supply'],
+                                                                          travel_rng = streams['travel'],
+                                                                          #same City as bench_city_dispatch, the NYC zone geometry doesn't apply
+                                                                          city_options = {'geometry': None})
+    durations = [time.perf_counter() - tic]
+    return {'simulate_with_individual_drivers': result(durations, len(arrivals))}, fleet
+
+def bench_driver_animation(fleet, frames = 300, fps = 60, speed = 15, seed = 0):
+    """Builds the position dataframe nycuberviz would use, with each zone drawn as one random point"""
+    rng = np.random.default_rng(seed)
+    histories = []
+    for d in fleet:
+        df = d.return_movement_dataframe()
+        df['driver_id'] = d.driver_id
+        histories.append(df)
+    history = pd.concat(histories).reset_index(drop = True)
+
+    zone_points = rng.uniform(0, 800, size = (int(max(history.start_zone.max(), history.end_zone.max())) + 1, 2))
+    history[['startx', 'starty']] = zone_points[history.start_zone.astype(int)]
+    history[['endx', 'endy']] = zone_points[history.end_zone.astype(int)]
+
+    animation = DriverAnimation(history, speed, fps)
+    durations = time_it(lambda: [animation.update() for i in range(frames)], repeat = 1)
+    return {'driver_animation_update': result(durations, frames)}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_benchmarks(zones = 263, drivers = 12000, arrivals = 450000, repeat = 3, seed = 0, skip_day = False):
+    inputs = synthetic_inputs(zones, arrivals, seed = seed)
+    results = {}
+
+    #the simulator prints progress, keep the benchmark output readable
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        results.update(bench_event_list(repeat = repeat, seed = seed))
+        results.update(bench_city_dispatch(inputs, drivers, repeat = repeat, seed = seed))
+        results.update(bench_generate_arrivals(inputs, repeat = repeat, seed = seed))
+        results.update(bench_driver_schedules(drivers, repeat = repeat, seed = seed))
+        if not skip_day:
+            day, fleet = bench_simulation_day(inputs, drivers, seed = seed)
+            results.update(day)
+            results.update(bench_driver_animation(fleet, seed = seed))
+
+    return {'commit': git_commit(),
+            'timestamp': datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'parameters': {'zones': zones, 'drivers': drivers, 'arrivals': arrivals, 'repeat': repeat, 'seed': seed},
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                            'machine': platform.machine(), 'processor': platform.processor()},
+            'results': results}
+
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print(f"{'benchmark':<36}{old['commit'] or 'old':>12}{new['commit'] or 'new':>12}{'change':>10}")
+    for name in new['results']:
+        if name in old['results']:
+            before, after = old['results'][name]['best'], new['results'][name]['best']
+            print(f'{name:<36}{before:>11.3f}s{after:>11.3f}s{(after / before - 1) * 100:>+9.1f}%')
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'compare':
+        compare(sys.argv[2], sys.argv[3])
+        sys.exit()
+
+    parser = argparse.ArgumentParser(description = 'Time the simulator hot paths on a synthetic city')
+    parser.add_argument('--zones', type = int, default = 263)
+    parser.add_argument('--drivers', type = int, default = 12000)
+    parser.add_argument('--arrivals', type = int, default = 450000, help = 'expected arrivals per day')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--skip-day', action = 'store_true', help = "don't run the full day simulation (the slowest benchmark)")
+    parser.add_argument('--output', default = None, help = 'JSON file to write (default bench_results/<timestamp>_<commit>.json)')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.zones, args.drivers, args.arrivals, args.repeat, args.seed, args.skip_day)
+    for name, r in report['results'].items():
+        print(f"{name:<36}best {r['best']:.4f}s  ({r['best_per_operation_us']:.2f} us per operation, {r['operations']} operations)")
+
+    output_file = args.output
+    if output_file is None:
+        os.makedirs('bench_results', exist_ok = True)
+        output_file = os.path.join('bench_results', f"{report['timestamp'].replace(':', '')}_{report['commit'] or 'nocommit'}.json")
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent = 2)
+    print(f'Results written to {output_file}')
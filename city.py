@@ -2,6 +2,9 @@ from city_elements import *
 from event_list import *
 import numpy as np
 import time
+import heapq
+from collections import defaultdict
+from itertools import islice
 
 class ZoneDict:
     """Representing every zone in a dictionary of sets with keys as the zone ids"""
@@ -68,12 +71,198 @@ class DriverStatus:
     def get_status_counts(self):
         return {s:len(self.status[s]) for s in self.status}
 
+class UnservedQueue:
+    """Passengers waiting for any driver to free up, indexed by pickup zone
+
+    Every zone has its own first come first served queue, and a heap of the zone queue heads (arrival time, passenger, zone)
+    orders the zones, so both the oldest passenger in a few given zones and the oldest passenger anywhere are cheap to find.
+    Heap entries of heads that were served through pop_nearest are left in the heap and skipped later
+    """
+    def __init__(self):
+        self.queues = defaultdict(deque)
+        self.heads = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, passenger, zone, arrival_time):
+        queue = self.queues[zone]
+        queue.append((arrival_time, passenger))
+        self.count += 1
+        if len(queue) == 1:
+            heapq.heappush(self.heads, (arrival_time, passenger, zone))
+
+    def pop_from_zone(self, zone):
+        queue = self.queues[zone]
+        arrival_time, passenger = queue.popleft()
+        self.count -= 1
+        if len(queue) > 0:
+            heapq.heappush(self.heads, (queue[0][0], queue[0][1], zone))
+        return passenger
+
+    def popleft(self):
+        #oldest waiting passenger anywhere in the city
+        while len(self.heads) > 0:
+            arrival_time, passenger, zone = heapq.heappop(self.heads)
+            queue = self.queues[zone]
+            if len(queue) > 0 and queue[0][1] == passenger:
+                #the entry is still the head of its zone, pop_from_zone pushes the next head
+                return self.pop_from_zone(zone)
+        return None
+
+    def pop_nearest(self, zone, nearby_zones):
+        #oldest waiting passenger in the zone or the nearby zones, otherwise the oldest passenger anywhere
+        best_zone, best_time = None, None
+        for z in [zone, *nearby_zones]:
+            queue = self.queues.get(z)
+            if queue and (best_time is None or queue[0][0] < best_time):
+                best_zone, best_time = z, queue[0][0]
+        if best_zone is None:
+            return self.popleft()
+        return self.pop_from_zone(best_zone)
+
+class BusyDriverIndex:
+    """Busy drivers keyed by the time they're projected to be free and the zone they'll be in then
+
+    Every driver has one live entry (free time, sequence #, driver, zone) in the heap of its final zone and in a global heap.
+    Updating a driver gives it a new sequence #, the older entries are left in the heaps and skipped when they reach the top
+    """
+    def __init__(self):
+        self.zone_heaps = defaultdict(list)
+        self.all_drivers = []
+        self.current = {}
+        self.sequence = 0
+        self.entries = 0
+
+    def __len__(self):
+        return len(self.current)
+
+    def update(self, driver, free_time, zone):
+        self.sequence += 1
+        entry = (free_time, self.sequence, driver, zone)
+        self.current[driver] = entry
+        heapq.heappush(self.zone_heaps[zone], entry)
+        heapq.heappush(self.all_drivers, entry)
+        self.entries += 1
+        if self.entries > 4 * len(self.current) + 1024:
+            self.rebuild()
+
+    def remove(self, driver):
+        self.current.pop(driver, None)
+
+    def projection(self, driver):
+        #(free time, zone) of an indexed driver
+        entry = self.current[driver]
+        return entry[0], entry[3]
+
+    def top(self, heap):
+        #drop stale entries until the top of the heap is a live one
+        while len(heap) > 0 and self.current.get(heap[0][2]) is not heap[0]:
+            heapq.heappop(heap)
+        return heap[0] if len(heap) > 0 else None
+
+    def soonest(self, pickup_zone, nearby_zones, mean_times):
+        """Driver that can reach pickup_zone first (free time + mean time from its final zone), among the drivers finishing in
+           pickup_zone or nearby_zones, otherwise the driver that is free first anywhere
+        """
+        best, best_time = None, None
+        for z in [pickup_zone, *nearby_zones]:
+            entry = self.top(self.zone_heaps[z]) if z in self.zone_heaps else None
+            if entry is not None:
+                reach_time = entry[0] + mean_times[z - 1, pickup_zone - 1]
+                if best_time is None or reach_time < best_time:
+                    best, best_time = entry[2], reach_time
+        if best is None:
+            entry = self.top(self.all_drivers)
+            best = entry[2] if entry is not None else None
+        return best
+
+    def rebuild(self):
+        live = sorted(self.current.values())
+        self.zone_heaps = defaultdict(list)
+        for entry in live:
+            self.zone_heaps[entry[3]].append(entry)
+        self.all_drivers = live
+        self.entries = len(live)
+
+class BatchDispatcher:
+    """Buffers arrivals for a window of simulated time and then assigns the whole batch to the free drivers at once
+
+       window = length of the batching window in minutes (ex. 0.25 = 15 seconds)
+       solver = 'hungarian' minimizes the total expected pickup time of the batch,
+                'greedy' repeatedly matches the remaining passenger and free driver that are closest to each other
+    """
+    def __init__(self, window, solver = 'hungarian'):
+        if solver not in ('hungarian', 'greedy'):
+            raise ValueError(f"Unknown dispatch solver '{solver}', use 'hungarian' or 'greedy'")
+        self.window = window
+        self.solver = solver
+        self.pending = []
+        self.window_open = False
+
+    def add_arrival(self, event):
+        #the first arrival after a dispatch opens the next window
+        self.pending.append(event.passenger)
+        if not self.window_open:
+            self.window_open = True
+            return DispatchWindow(event.time + self.window)
+
+    def close_window(self):
+        passengers = self.pending
+        self.pending = []
+        self.window_open = False
+        return passengers
+
+    def match(self, pickups, zones, counts, mean_times):
+        """Returns (passenger position, driver zone) pairs
+           pickups = pickup zone of every passenger, zones/counts = zones with free drivers and how many
+        """
+        #cost of sending a driver from each zone to each passenger = the mean movement time
+        costs = mean_times[zones - 1][:, pickups - 1].T
+
+        if self.solver == 'hungarian':
+            #scipy.optimize is slow to import and only needed with batched dispatch
+            from scipy.optimize import linear_sum_assignment
+            #one column per driver that can be used (a zone never needs more drivers than there are passengers)
+            columns = np.repeat(np.arange(len(zones)), np.minimum(counts, len(pickups)))
+            costs = costs[:, columns]
+            #some optimal assignment only uses drivers among each passenger's len(pickups) cheapest ones, drop the rest
+            if costs.shape[1] > len(pickups):
+                keep = np.unique(np.argpartition(costs, len(pickups) - 1, axis = 1)[:, :len(pickups)])
+                columns, costs = columns[keep], costs[:, keep]
+            rows, assigned = linear_sum_assignment(costs)
+            return [(r, zones[columns[c]]) for r, c in zip(rows, assigned)]
+
+        remaining = counts.copy()
+        matched = np.zeros(len(pickups), dtype = bool)
+        matches = []
+        for flat in np.argsort(costs, axis = None, kind = 'stable'):
+            r, c = divmod(flat, len(zones))
+            if not matched[r] and remaining[c] > 0:
+                matched[r] = True
+                remaining[c] -= 1
+                matches.append((r, zones[c]))
+                if len(matches) == min(len(pickups), counts.sum()):
+                    break
+        return matches
+
 class City:
     
-    def __init__(self, name, zone_ids, drivers, odmatrix):
+    def __init__(self, name, zone_ids, drivers, odmatrix, passengers, rng = None, dispatch_window = None, dispatch_solver = 'hungarian',
+                 unserved_search_zones = 5, busy_search_zones = 5, geometry = None):
         self.name = name
+        #PassengerTable, passengers everywhere else in the city are row ids of this table
+        self.passengers = passengers
+        self.rng = np.random.default_rng(rng)
         self.zones = ZoneDict(zone_ids)
-        self.unserved_customers = deque()
+        #a driver that frees up serves the oldest waiting passenger in its zone or its closest unserved_search_zones zones
+        self.unserved_customers = UnservedQueue()
+        self.unserved_search_zones = unserved_search_zones
+        #when no driver is free, passengers are queued on the busy driver that can reach them first
+        #among the drivers finishing in their zone or its closest busy_search_zones zones
+        self.busy_drivers = BusyDriverIndex()
+        self.busy_search_zones = busy_search_zones
         self.driver_status = DriverStatus(['inactive','free','busy','max_queue','marked_for_departure'])
 
         #add available drivers to the set of free drivers based on end < start
@@ -86,37 +275,62 @@ class City:
 
         self.odmatrix = []
 
+        #zones with travel time information (all zones 1, 2, ..., n so list positions are zone_id - 1)
+        od_zone_ids = np.sort(odmatrix.index.get_level_values(0).unique())
+
         #convert odmatrix into a list of lists (faster access)
-        for i in np.arange(1,264):
+        for i in od_zone_ids:
             list_of_info = [v for v in odmatrix.loc[i].values]
             self.odmatrix.append(list_of_info)
         
-        #use the odmatrix to judge the closest zones
-        #dictionary of values with key = zone_id
-        #and the value is a pandas index listing the closest zones by mean travel time
-        self.closest_zones = {}
-        for i in np.arange(1,264):
-            dotimes = odmatrix.loc[i]
-            ordered = dotimes[~(dotimes == 0).all(axis=1)].sort_values(by = 'mean')
-            if i in ordered.index:
-                ordered = ordered.drop(index = i)
-            self.closest_zones[i] = ordered.index
-        
-        #set some default value using the overall mean
-        #doesn't take into account anything, is definitely a bad solution
-        #better is to take into account geographic distance and maybe traffic
-        default_means = []
-        for i in np.arange(1,264):
-            do_info = odmatrix.loc[(slice(None),i),:]
-            if do_info['count'].sum() == 0:
-                do_info = odmatrix.loc[(i,slice(None)),:]
-            if do_info['count'].sum() != 0:
-                #ignore the zone bc there's no pickups or dropoffs from it
-                exp_mean = np.sum(do_info['mean'] * do_info['count']) / do_info['count'].sum()
-                default_means.append(exp_mean)
-            else:
-                default_means.append(np.mean(default_means))
-        self.default_times = default_means
+        od = np.array(self.odmatrix)
+        missing = (od == 0).all(axis = 2)
+
+        if geometry is not None:
+            #zone geometry tables (zone_geometry.py), missing pairs get the time estimated from the centroid distance
+            if not np.array_equal(geometry['zone_ids'], od_zone_ids):
+                raise ValueError('The zone geometry has to cover the same zones as the OD matrix')
+            fallback_times = np.asarray(geometry['fallback_times'], dtype = float)
+            self.mean_times = np.where(missing, fallback_times, od[:, :, 0])
+            self.fallback_times = fallback_times.tolist()
+
+            #closest zones by mean travel time (estimated for the pairs without OD data), precomputed in the tables
+            self.closest_zones = dict(zip(od_zone_ids, np.asarray(geometry['closest_zones'], dtype = np.int64)))
+        else:
+            #use the odmatrix to judge the closest zones
+            #dictionary of values with key = zone_id
+            #and the value is a pandas index listing the closest zones by mean travel time
+            self.closest_zones = {}
+            for i in od_zone_ids:
+                dotimes = odmatrix.loc[i]
+                ordered = dotimes[~(dotimes == 0).all(axis=1)].sort_values(by = 'mean')
+                if i in ordered.index:
+                    ordered = ordered.drop(index = i)
+                self.closest_zones[i] = ordered.index
+            
+            #set some default value using the overall mean
+            #doesn't take into account anything, is definitely a bad solution
+            #better is to take into account geographic distance and maybe traffic (pass geometry)
+            default_means = []
+            for i in od_zone_ids:
+                do_info = odmatrix.loc[(slice(None),i),:]
+                if do_info['count'].sum() == 0:
+                    do_info = odmatrix.loc[(i,slice(None)),:]
+                if do_info['count'].sum() != 0:
+                    #ignore the zone bc there's no pickups or dropoffs from it
+                    exp_mean = np.sum(do_info['mean'] * do_info['count']) / do_info['count'].sum()
+                    default_means.append(exp_mean)
+                else:
+                    default_means.append(np.mean(default_means))
+            self.default_times = default_means
+
+            #mean movement time between every pair of zones (array indexed by zone_id - 1), using the defaults for missing pairs
+            self.mean_times = np.where(missing, np.array(self.default_times)[None, :], od[:, :, 0])
+            #the same default for every pickup zone
+            self.fallback_times = [self.default_times] * len(od_zone_ids)
+
+        #dispatch every arrival immediately unless a batching window is given
+        self.dispatcher = BatchDispatcher(dispatch_window, dispatch_solver) if dispatch_window else None
 
         self.timed_stats = {'generating_movement_times':[0,0]}
 
@@ -136,40 +350,37 @@ class City:
 
         elif event.type == 'Driver Departure':
             return self.process_driver_departure(event)
+
+        elif event.type == 'Dispatch Window':
+            return self.process_dispatch_window(event)
     
     def generate_movement_time(self, pu, do):
         
         tic = time.time()
         movement_info = self.odmatrix[pu - 1][do - 1]
         if (movement_info == 0).all():
-            #if there's no movement information, try to generate an exponential var from the weighted
-            #mean for the dropoff location
-            m = np.random.exponential(self.default_times[do - 1])
+            #if there's no movement information, try to generate an exponential var from the fallback mean
+            #(estimated from the zone distance with geometry, otherwise the weighted mean for the dropoff location)
+            m = self.rng.exponential(self.fallback_times[pu - 1][do - 1])
         else:
-            m = max(np.random.normal(loc = movement_info[0], scale = movement_info[1]), movement_info[2])
+            m = max(self.rng.normal(loc = movement_info[0], scale = movement_info[1]), movement_info[2])
         toc = time.time()
         self.timed_stats['generating_movement_times'][0] += toc - tic
         self.timed_stats['generating_movement_times'][1] += 1
         return m
     
     def process_arrival_event(self, event):
-        pickup_zone = event.passenger.start
+        #with batched dispatch the passenger waits for the end of the current window
+        if self.dispatcher is not None:
+            return self.dispatcher.add_arrival(event)
+
+        pickup_zone = self.passengers.start[event.passenger]
 
         #first search for a driver in the same pickup zone as the passenger
         chosen_driver = self.zones.get_driver(pickup_zone)
         if chosen_driver:
             #if the driver is not moving, then the driver can immediately serve the passenger
-            #system changes - remove driver from the pickup zone and shift the driver's status
-            self.zones.remove_driver(pickup_zone, chosen_driver)
-            self.driver_status.shift_driver(chosen_driver, 'free', 'busy')
-
-            #add the passenger to the driver queue and send the driver to the same zone
-            chosen_driver.add_passenger(event.passenger)
-            chosen_driver.add_start_of_movement(event.time, pickup_zone)
-            movement_time = self.generate_movement_time(pickup_zone, pickup_zone)
-
-            #generate a movement event
-            return Movement(event.time + movement_time, chosen_driver, pickup_zone, pickup_zone)
+            return self.send_free_driver(event.time, chosen_driver, event.passenger)
         else:
             chosen_driver = None
             status_counts = self.driver_status.get_status_counts()
@@ -182,33 +393,80 @@ class City:
 
                 if chosen_driver is None:
                     chosen_driver = self.driver_status.get_driver_from_status('free')
-                zone = chosen_driver.last_location
                 
                 #the chosen driver is free, so generate a movement event from the driver to the customer
-                self.zones.remove_driver(zone, chosen_driver)
-                self.driver_status.shift_driver(chosen_driver, 'free', 'busy')
-
-                #add passenger and add the start of a movement
-                chosen_driver.add_passenger(event.passenger)
-                chosen_driver.add_start_of_movement(event.time, zone)
-
-                #generate a movement time for the movement
-                movement_time = self.generate_movement_time(zone, pickup_zone)
-                return Movement(event.time + movement_time, chosen_driver, zone, pickup_zone)
+                return self.send_free_driver(event.time, chosen_driver, event.passenger)
 
-            elif status_counts['busy'] > 0:
-                #choose any busy driver
-                chosen_driver = self.driver_status.get_driver_from_status('busy')
+            else:
+                self.hold_passenger(event.passenger)
 
-                #add passenger to the driver's queue
-                chosen_driver.add_passenger(event.passenger)
+    def send_free_driver(self, current_time, driver, passenger):
+        #system changes - remove driver from their zone and shift the driver's status
+        zone = driver.last_location
+        pickup_zone = self.passengers.start[passenger]
+        self.zones.remove_driver(zone, driver)
+        self.driver_status.shift_driver(driver, 'free', 'busy')
 
-                #shift the driver's status to max queue if the max queue is hit
-                if chosen_driver.hit_max_queue():
-                    self.driver_status.shift_driver(chosen_driver, 'busy','max_queue')
+        #add passenger and add the start of a movement
+        driver.add_passenger(passenger)
+        driver.add_start_of_movement(current_time, zone)
+
+        #generate a movement time for the movement
+        movement_time = self.generate_movement_time(zone, pickup_zone)
+        self.index_busy_driver(driver, current_time + movement_time + self.passengers.service[passenger], self.passengers.end[passenger], 1)
+        return Movement(current_time + movement_time, driver, zone, pickup_zone)
+
+    def index_busy_driver(self, driver, free_time, zone, skip = 0):
+        """Projects when and where a driver will be free, given that it's done with everything except its queue[skip:] at
+           free_time in zone, and indexes the driver if it can still take passengers
+        """
+        if not self.driver_status.driver_in_status(driver, 'busy'):
+            self.busy_drivers.remove(driver)
+            return
+        for p in islice(driver.passenger_queue, skip, None):
+            free_time += self.mean_times[zone - 1, self.passengers.start[p] - 1] + self.passengers.service[p]
+            zone = self.passengers.end[p]
+        self.busy_drivers.update(driver, free_time, zone)
+
+    def hold_passenger(self, passenger):
+        #there are no free drivers, queue the passenger on a busy driver or wait for any driver to free up
+        pickup_zone = self.passengers.start[passenger]
+        if len(self.busy_drivers) > 0:
+            #choose the busy driver that can get to the passenger first
+            chosen_driver = self.busy_drivers.soonest(pickup_zone, self.closest_zones[pickup_zone][:self.busy_search_zones], self.mean_times)
+
+            #add passenger to the driver's queue, the driver is free later and somewhere else
+            chosen_driver.add_passenger(passenger)
+            free_time, zone = self.busy_drivers.projection(chosen_driver)
+            free_time += self.mean_times[zone - 1, pickup_zone - 1] + self.passengers.service[passenger]
+
+            #shift the driver's status to max queue if the max queue is hit
+            if chosen_driver.hit_max_queue():
+                self.driver_status.shift_driver(chosen_driver, 'busy','max_queue')
+            self.index_busy_driver(chosen_driver, free_time, self.passengers.end[passenger], len(chosen_driver.passenger_queue))
 
-            else:
-                self.unserved_customers.append(event.passenger)
+        else:
+            self.unserved_customers.append(passenger, pickup_zone, self.passengers.time[passenger])
+
+    def process_dispatch_window(self, event):
+        #match every passenger that arrived during the window to the free drivers at once
+        passengers = self.dispatcher.close_window()
+        supply = {z: len(drivers) for z, drivers in self.zones.zones.items() if len(drivers) > 0}
+
+        new_events = []
+        matched = set()
+        if len(supply) > 0:
+            pickups = np.array([self.passengers.start[p] for p in passengers])
+            matches = self.dispatcher.match(pickups, np.array(list(supply)), np.array(list(supply.values())), self.mean_times)
+            for i, zone in matches:
+                new_events.append(self.send_free_driver(event.time, self.zones.get_driver(zone), passengers[i]))
+                matched.add(i)
+
+        #passengers left over when there are more passengers than free drivers
+        for i, p in enumerate(passengers):
+            if i not in matched:
+                self.hold_passenger(p)
+        return new_events
     
     def process_movement_event(self, event):
 
@@ -223,20 +481,23 @@ class City:
         driver.add_start_of_movement(event.time, event.end_zone)
         driver.passenger = passenger
 
-        return Trip(event.time + passenger.service, driver, passenger)
+        trip_end_time = event.time + self.passengers.service[passenger]
+        self.index_busy_driver(driver, trip_end_time, self.passengers.end[passenger])
+        return Trip(trip_end_time, driver, passenger, self.passengers.start[passenger], self.passengers.end[passenger])
     
     def process_trip_event(self, event):
         
         #at the end of a trip event the driver goes to the next passenger, is idle, or picks up from the unserved queue
         current_passenger = event.passenger
-        current_passenger.departure_time = event.time
+        self.passengers.record_departure(current_passenger, event.time)
         driver = event.driver
         driver.passenger = None
-        driver.add_end_of_movement(event.time, current_passenger.end, current_passenger)
+        driver.add_end_of_movement(event.time, event.end_zone(), current_passenger)
         
         #get next passenger
         passenger = driver.get_next_passenger()
         if passenger is None:
+            self.busy_drivers.remove(driver)
             self.zones.add_driver(event.end_zone(), driver)
             if self.driver_status.driver_in_status(driver, 'marked_for_departure'):
                 self.driver_status.shift_driver(driver, 'marked_for_departure', 'free')
@@ -244,19 +505,21 @@ class City:
                 self.driver_status.shift_driver(driver, 'busy', 'free')
 
             if driver.out_of_schedule(event.time):
-                driver_dep_event = DriverDeparture(driver, event.time)
-                return driver_dep_event
+                #the driver's departure event already went by while they were busy, so they leave right away
+                self.depart_driver(driver)
             else:
                 #if no departure is scheduled, start serving the customers waiting
                 if len(self.unserved_customers) > 0:
-                    passenger = self.unserved_customers.popleft()
-                    return self.serve_unserved_passenger(event.time, current_passenger.end, driver, passenger)
+                    passenger = self.next_unserved_passenger(event.end_zone())
+                    return self.serve_unserved_passenger(event.time, event.end_zone(), driver, passenger)
 
         else:
             #move to the next passenger
-            driver.add_start_of_movement(event.time, current_passenger.end)
-            movement_time = self.generate_movement_time(current_passenger.end, passenger.start)
-            return Movement(event.time + movement_time, driver, current_passenger.end, passenger.start)
+            pickup_zone = self.passengers.start[passenger]
+            driver.add_start_of_movement(event.time, event.end_zone())
+            movement_time = self.generate_movement_time(event.end_zone(), pickup_zone)
+            self.index_busy_driver(driver, event.time + movement_time + self.passengers.service[passenger], self.passengers.end[passenger], 1)
+            return Movement(event.time + movement_time, driver, event.end_zone(), pickup_zone)
 
     def process_driver_arrival(self, event):
         #add the driver to the free driver pool
@@ -268,23 +531,30 @@ class City:
         self.zones.add_driver(driver.start_zone, driver)
 
         if len(self.unserved_customers) > 0:
-            passenger = self.unserved_customers.popleft()
+            passenger = self.next_unserved_passenger(driver.start_zone)
             return self.serve_unserved_passenger(event.time, driver.start_zone, driver, passenger)
 
     def process_driver_departure(self, event):
 
         driver = event.driver
 
-        #if the driver is busy, just do nothing and another departure event will be generated
+        #a busy driver is only marked, they leave when their last trip ends (process_trip_event)
         if self.driver_status.driver_in_status(driver, 'free'):
-            self.driver_status.shift_driver(driver, 'free', 'inactive')
-            self.zones.remove_driver(driver.last_location, driver)
+            self.depart_driver(driver)
         #shift the other drivers into marked for departure, so that they aren't given new passengers
         elif self.driver_status.driver_in_status(driver, 'busy'):
             self.driver_status.shift_driver(driver, 'busy', 'marked_for_departure')
+            self.busy_drivers.remove(driver)
         elif self.driver_status.driver_in_status(driver, 'max_queue'):
             self.driver_status.shift_driver(driver, 'max_queue', 'marked_for_departure')
 
+    def depart_driver(self, driver):
+        self.driver_status.shift_driver(driver, 'free', 'inactive')
+        self.zones.remove_driver(driver.last_location, driver)
+
+    def next_unserved_passenger(self, zone):
+        return self.unserved_customers.pop_nearest(zone, self.closest_zones[zone][:self.unserved_search_zones])
+
     def serve_unserved_passenger(self, current_time, current_location, driver, passenger):
         #shift the driver from free to busy and remove the driver from where they are currently
         self.driver_status.shift_driver(driver, 'free', 'busy')
@@ -294,8 +564,10 @@ class City:
         driver.add_passenger(passenger)
         driver.add_start_of_movement(current_time, current_location)
 
-        movement_time = self.generate_movement_time(current_location, passenger.start)
-        return Movement(current_time + movement_time, driver, current_location, passenger.start)
+        pickup_zone = self.passengers.start[passenger]
+        movement_time = self.generate_movement_time(current_location, pickup_zone)
+        self.index_busy_driver(driver, current_time + movement_time + self.passengers.service[passenger], self.passengers.end[passenger], 1)
+        return Movement(current_time + movement_time, driver, current_location, pickup_zone)
 
     def formatted_stats(self):
         s = ''
@@ -1,12 +1,14 @@
 from collections import deque
 import pandas as pd
+import numpy as np
 
 class Driver:
     
     #can add behaviors here like time schedule, max distance allowed
-    def __init__(self, start_zone, schedule_start, schedule_end):
+    def __init__(self, start_zone, schedule_start, schedule_end, driver_id = None):
         self.start, self.end = schedule_start, schedule_end
         self.start_zone = start_zone
+        self.driver_id = driver_id
 
         self.last_location = start_zone
         self.last_time = 0
@@ -33,7 +35,7 @@ class Driver:
         self.last_time = start_time
 
     def add_end_of_movement(self, end_time, end, passenger = None):
-        self.movement_history.append((self.last_time, end_time, self.last_location, end, True, passenger != None, len(self.passenger_queue)))
+        self.movement_history.append((self.last_time, end_time, self.last_location, end, True, passenger is not None, len(self.passenger_queue)))
         self.last_time = end_time
         self.last_location = end
     
@@ -49,6 +51,12 @@ class Driver:
     def hit_max_queue(self):
         return len(self.passenger_queue) >= 3
 
+    def __hash__(self):
+        #drivers live in sets all over the city, hashing by id makes the order they're picked in (and so a seeded run) repeatable
+        if self.driver_id is None:
+            return object.__hash__(self)
+        return hash(self.driver_id)
+
     def return_movement_dataframe(self):
         return pd.DataFrame(self.movement_history, columns = ['start_time', 'end_time', 'start_zone', 'end_zone', 'is_moving', 'has_passenger', 'queue_length'])
     
@@ -66,3 +74,36 @@ class Passenger:
         
     def __str__(self):
         return f"Arrival Time: {self.time} \nStart Zone: {self.start} \nEnd Zone: {self.end} \nTrip Time: {self.service}"
+
+class PassengerTable:
+    """Every passenger of a day as one row of a float array, events and driver queues refer to passengers by row id
+
+    Columns are stored in output order, so the output dataframe is a view of the table instead of a copy
+    """
+    COLUMNS = ['arrival_time', 'starting zone', 'ending zone', 'service_time', 'waiting_time', 'departure_time']
+
+    def __init__(self, arrivals):
+        #arrivals = array(n, 4) of (arrival time, start zone, end zone, service time)
+        arrivals = np.asarray(arrivals, dtype = float)
+        self.data = np.full((len(arrivals), len(self.COLUMNS)), np.nan)
+        self.data[:, :4] = arrivals[:, :4]
+
+        self.time = self.data[:, 0]
+        self.service = self.data[:, 3]
+        self.departure_time = self.data[:, 5]
+        #zones are read for every event, plain lists of ints are faster to index than numpy arrays
+        self.start = arrivals[:, 1].astype(int).tolist()
+        self.end = arrivals[:, 2].astype(int).tolist()
+
+    def __len__(self):
+        return len(self.data)
+
+    def record_departure(self, passenger_id, departure_time):
+        self.departure_time[passenger_id] = departure_time
+
+    def waiting_time(self):
+        return self.departure_time - self.service - self.time
+
+    def return_passenger_dataframe(self):
+        self.data[:, 4] = self.waiting_time()
+        return pd.DataFrame(self.data[:, :5], columns = self.COLUMNS[:5], copy = False)
@@ -1,17 +1,21 @@
 from re import T
 from city_elements import *
 import time
+from bisect import bisect_right
 
 class Event:
     
     def __init__(self, time_of_event, type):  
         self.time = time_of_event
         self.type = type
+        #bumped every time the event is cancelled, entries of an older generation in the event list are dead
+        self.generation = 0
+        self.scheduled = False
         
 class Arrival(Event):
     
-    def __init__(self, passenger):
-        Event.__init__(self, passenger.time, 'Arrival')
+    def __init__(self, arrival_time, passenger):
+        Event.__init__(self, arrival_time, 'Arrival')
         self.passenger = passenger
 
 class DriverArrival(Event):
@@ -43,48 +47,97 @@ class Movement(Event):
 
 class Trip(Event):
 
-    def __init__(self, end_of_trip_time, driver, passenger):
+    def __init__(self, end_of_trip_time, driver, passenger, pickup_zone, dropoff_zone):
         Event.__init__(self, end_of_trip_time, 'Trip')
         self.driver = driver
         self.passenger = passenger
+        self.pickup_zone = pickup_zone
+        self.dropoff_zone = dropoff_zone
     
     def start_zone(self):
-        return self.passenger.start
+        return self.pickup_zone
 
     def end_zone(self):
-        return self.passenger.end
+        return self.dropoff_zone
+
+class DispatchWindow(Event):
+
+    def __init__(self, end_of_window_time):
+        Event.__init__(self, end_of_window_time, 'Dispatch Window')
+
+class EntryTimes:
+    """Read only view of the times of (time, generation, event) entries, for bisect (which can't take a key before python 3.10)"""
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        return self.entries[i][0]
 
 class EventList:
+    """Events in time order, stored as (time, generation, event) entries
+
+    An inserted event is its own handle: cancel(event) and reschedule(event, time) are O(1) on the existing entry,
+    they only bump the event's generation. Entries whose generation no longer matches their event are dead and are
+    dropped when they reach the front, so iterate_next_event only ever returns live events
+    """
     
     def __init__(self, initial_event_list):
-        self.events = deque(sorted(initial_event_list, key = lambda e: e.time))
+        for e in initial_event_list:
+            e.scheduled = True
+        self.events = deque((e.time, e.generation, e) for e in sorted(initial_event_list, key = lambda e: e.time))
+        self.dead = 0
         self.timed_stats = {'insertion speed':[0,0], 
                             'search speed':[0,0]}
         
     def insert_event(self, event):
         
-        #binary search
+        #binary search over the entry times, after any entries with the same time
         tic = time.time()
-        bounds = [0,len(self.events) - 1]
-        while bounds[0] < bounds[1]:
-            i = (bounds[1] + bounds[0])//2
-            if self.events[i].time > event.time:
-                bounds[1] = i - 1
-            elif self.events[i].time == event.time:
-                bounds[0] = i
-                bounds[1] = i
-            else:
-                bounds[0] = i + 1
+        i = bisect_right(EntryTimes(self.events), event.time)
         toc = time.time()
         self.timed_stats['search speed'][0] += toc - tic
         self.timed_stats['search speed'][1] += 1
-        self.events.insert(bounds[0], event)
+        self.events.insert(i, (event.time, event.generation, event))
+        event.scheduled = True
+        return event
+
+    def cancel(self, event):
+        #the entry stays in place and is skipped once it reaches the front
+        if event.scheduled:
+            event.generation += 1
+            event.scheduled = False
+            self.dead += 1
+
+    def reschedule(self, event, new_time):
+        self.cancel(event)
+        event.time = new_time
+        return self.insert_event(event)
         
     def iterate_next_event(self):
-        return self.events.popleft()
+        while True:
+            t, generation, event = self.events.popleft()
+            if generation == event.generation:
+                event.scheduled = False
+                return event
+            self.dead -= 1
         
+    def next_event_time(self):
+        #time of the next live event without popping it (inf if there are none)
+        while len(self.events) > 0 and self.events[0][1] != self.events[0][2].generation:
+            self.events.popleft()
+            self.dead -= 1
+        return self.events[0][0] if len(self.events) > 0 else float('inf')
+
     def is_finished(self):
-        return len(self.events) == 0
+        return len(self.events) == self.dead
+
+    def __len__(self):
+        #number of live events
+        return len(self.events) - self.dead
 
     def formatted_stats(self):
         s = ''
@@ -3,13 +3,14 @@ import numpy as np
 import os
 from tqdm import tqdm
 
-def generate_points_random(zone_id, num_required, zone_dict, extent_dict):
+def generate_points_random(zone_id, num_required, zone_dict, extent_dict, rng = None):
+	rng = np.random.default_rng(rng)
 	bounds = extent_dict[zone_id]
 	path = zone_dict[zone_id]
 	generated_points = np.array([])
 	while len(generated_points) < num_required:
-		xs = np.random.uniform(bounds[0][0], bounds[1][0], size = num_required*2)
-		ys = np.random.uniform(bounds[0][1], bounds[1][1], size = num_required*2)
+		xs = rng.uniform(bounds[0][0], bounds[1][0], size = num_required*2)
+		ys = rng.uniform(bounds[0][1], bounds[1][1], size = num_required*2)
 		points = np.c_[xs,ys]
 		points_filtered = points[path.contains_points(points)]
 		if len(generated_points) == 0:
@@ -18,16 +19,17 @@ def generate_points_random(zone_id, num_required, zone_dict, extent_dict):
 			generated_points = np.append(generated_points, points_filtered, axis = 0)
 	return generated_points[:num_required].round()
 
-def generate_points_lines(zone_id, num_required, zone_dict, extent_dict):
+def generate_points_lines(zone_id, num_required, zone_dict, extent_dict, rng = None):
     path = zone_dict[zone_id]
     v = path.vertices[0]
     return v * np.ones((num_required, 2))
 
-def generate_positions(driver_movement_filenames, zone_dict, folder, mode = 'random'):
+def generate_positions(driver_movement_filenames, zone_dict, folder, mode = 'random', rng = None):
 
     filepath = f'output/{folder}/driver_generated_points_{mode}'
 
     #load some provided driver movement data
+    rng = np.random.default_rng(rng)
     driver_history = pd.read_parquet(driver_movement_filenames).reset_index(drop = True)
     extent_dict = {k:(v.get_extents().min, v.get_extents().max) for k,v in zone_dict.items()}
     if mode == 'random':
@@ -50,7 +52,7 @@ def generate_positions(driver_movement_filenames, zone_dict, folder, mode = 'ran
             position = 0, 
             leave = True, 
             desc = 'Points Generated per Zone'):
-            positions_generated = point_generation_function(i, points_required.loc[i], zone_dict = zone_dict, extent_dict=extent_dict)
+            positions_generated = point_generation_function(i, points_required.loc[i], zone_dict = zone_dict, extent_dict=extent_dict, rng = rng)
             pos_df = pd.DataFrame(positions_generated, columns = ['x','y'])
             pos_df['end_zone'] = i
             positions.append(pos_df)
@@ -0,0 +1,147 @@
+import pandas as pd
+import numpy as np
+from joblib import load
+import json
+import os
+import sys
+
+"""A single binary file holding every simulation input as dense arrays, so each process can memory map it
+   instead of unpickling and re-deriving dataframes
+
+Layout: 8 byte magic, uint32 format version, uint32 header length, a JSON header describing every array
+(dtype, shape, byte offset) and then the raw arrays, each aligned to ALIGNMENT bytes
+"""
+MAGIC = b'UBERSIM\x00'
+BUNDLE_VERSION = 1
+ALIGNMENT = 64
+
+INPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input_data')
+DEFAULT_BUNDLE_PATH = os.path.join(INPUT_DIR, 'input_bundle')
+SOURCE_FILES = ['arrival_and_dropoff_distributions', 'trip_time_means', 'minimum_active_uber_trips']
+
+OD_COLUMNS = ['mean', 'std', 'min', 'max', 'count']
+ZONE_IDS = np.arange(1, 264)
+
+def write_bundle(file_name, arrays, metadata = None, version = BUNDLE_VERSION):
+    """Writes a dictionary of name:np.array to file_name in the bundle layout"""
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+
+    #offsets are relative to the start of the data section, which starts after the (padded) header
+    entries = {}
+    offset = 0
+    for name, a in arrays.items():
+        entries[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+        offset += -(-a.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'arrays': entries, 'metadata': metadata or {}}).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    with open(file_name, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([version, len(header)], dtype = '<u4').tobytes())
+        f.write(header)
+        for name, a in arrays.items():
+            f.seek(data_start + entries[name]['offset'])
+            f.write(a.tobytes())
+        #make sure the file covers the padding of the last array
+        f.truncate(data_start + offset)
+
+def read_bundle(file_name, version = BUNDLE_VERSION):
+    """Memory maps a bundle, returns (dictionary of read only arrays, metadata)
+       The arrays are views into one shared mapping, so nothing is copied until it is written to
+    """
+    with open(file_name, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{file_name} is not an input bundle')
+        file_version, header_length = np.frombuffer(f.read(8), dtype = '<u4')
+        if file_version != version:
+            raise ValueError(f'{file_name} has bundle version {file_version}, expected {version} (recompile it)')
+        header = json.loads(f.read(int(header_length)))
+    data_start = -(-(len(MAGIC) + 8 + int(header_length)) // ALIGNMENT) * ALIGNMENT
+
+    mapped = np.memmap(file_name, dtype = np.uint8, mode = 'r')
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype = np.int64))
+        start = data_start + entry['offset']
+        arrays[name] = np.frombuffer(mapped, dtype = dtype, count = count, offset = start).reshape(entry['shape'])
+    return arrays, header['metadata']
+
+def bundle_is_current(file_name = DEFAULT_BUNDLE_PATH, input_dir = INPUT_DIR):
+    """A bundle is only used if it exists and is newer than every file it was compiled from"""
+    if not os.path.exists(file_name):
+        return False
+    bundle_time = os.path.getmtime(file_name)
+    return all(os.path.getmtime(os.path.join(input_dir, s)) <= bundle_time
+               for s in SOURCE_FILES if os.path.exists(os.path.join(input_dir, s)))
+
+def od_stats_array(trip_time_data, zone_ids):
+    """Dense array(zones, zones, 5) of the trip time stats, indexed by the positions of zone_ids (missing pairs are 0)"""
+    #the parquet file isn't fully sorted, so line it up with the dense (pickup, dropoff) grid first
+    full_index = pd.MultiIndex.from_product([zone_ids, zone_ids], names = trip_time_data.index.names)
+    od_stats = trip_time_data.reindex(full_index, fill_value = 0)[OD_COLUMNS].values
+    return od_stats.reshape((len(zone_ids), len(zone_ids), len(OD_COLUMNS)))
+
+def dense_input_arrays(hourly_arrival_rate, dropoff_frequency, trip_time_data, zone_ids = ZONE_IDS):
+    """The simulation input dataframes as dense arrays indexed by zone_id - 1 (the inverse of the *_frame functions below)"""
+    n = len(zone_ids)
+    hourly_rates = np.zeros((n, 24))
+    dropoff_probabilities = np.zeros((n, n))
+    has_pickup_data = np.zeros(n, dtype = bool)
+
+    rows = np.searchsorted(zone_ids, hourly_arrival_rate.index.values)
+    hourly_rates[rows] = hourly_arrival_rate.reindex(columns = np.arange(24), fill_value = 0).values
+    dropoff_probabilities[rows] = dropoff_frequency.loc[hourly_arrival_rate.index].reindex(columns = zone_ids, fill_value = 0).values
+    has_pickup_data[rows] = True
+
+    return {'zone_ids': np.asarray(zone_ids).astype(np.int32),
+            'hourly_rates': hourly_rates,
+            'has_pickup_data': has_pickup_data,
+            'dropoff_probabilities': dropoff_probabilities,
+            'od_stats': od_stats_array(trip_time_data, zone_ids).astype(np.float64)}
+
+def compile_input_bundle(file_name = DEFAULT_BUNDLE_PATH, input_dir = INPUT_DIR):
+    """Reads the pickle/parquet/joblib inputs once and writes them as dense arrays indexed by zone_id - 1
+
+    hourly_rates = array(263, 24) arrivals per hour for each pickup zone (0 for zones without pickup data)
+    has_pickup_data = array(263) whether the zone had an entry in the arrival distributions
+    dropoff_probabilities = array(263, 263) dropoff distribution for every pickup zone
+    od_stats = array(263, 263, 5) trip time mean, std, min, max, count for every (pickup, dropoff) pair
+    availability = array(1440) minimum # of active drivers for every minute of the day
+    """
+    pickup_data = pd.read_pickle(os.path.join(input_dir, 'arrival_and_dropoff_distributions'))
+    trip_time_data = pd.read_parquet(os.path.join(input_dir, 'trip_time_means'))
+    minimum_active_trips = load(os.path.join(input_dir, 'minimum_active_uber_trips'))
+
+    arrays = dense_input_arrays(pickup_data.apply(lambda item: item[0]),
+                                pickup_data.apply(lambda item: item[1] / item[1].sum()),
+                                trip_time_data)
+    arrays['availability'] = minimum_active_trips['Driver Count'].values.astype(np.float64)
+    write_bundle(file_name, arrays, metadata = {'od_columns': OD_COLUMNS, 'sources': SOURCE_FILES})
+    return arrays
+
+"""Converters from the bundle arrays back to the dataframe shapes the simulation functions take
+   Only the zones with pickup data are kept, matching the original pickled data
+"""
+def hourly_arrival_rate_frame(arrays):
+    mask = arrays['has_pickup_data']
+    return pd.DataFrame(arrays['hourly_rates'][mask],
+                        index = pd.Index(arrays['zone_ids'][mask].astype(np.int64), name = 'pulocationid'))
+
+def dropoff_frequency_frame(arrays):
+    mask = arrays['has_pickup_data']
+    return pd.DataFrame(arrays['dropoff_probabilities'][mask],
+                        index = pd.Index(arrays['zone_ids'][mask].astype(np.int64), name = 'pulocationid'),
+                        columns = arrays['zone_ids'].astype(np.int64))
+
+def trip_time_frame(arrays):
+    #reshape of the mapped array is a view, so the frame is backed by the bundle itself
+    zone_ids = arrays['zone_ids'].astype(np.int64)
+    od_stats = arrays['od_stats']
+    index = pd.MultiIndex.from_product([zone_ids, zone_ids], names = ['pulocationid', None])
+    return pd.DataFrame(od_stats.reshape((-1, od_stats.shape[-1])), index = index, columns = OD_COLUMNS, copy = False)
+
+if __name__ == '__main__':
+    output_file_name = sys.argv[1] if len(sys.argv) == 2 else DEFAULT_BUNDLE_PATH
+    compile_input_bundle(output_file_name)
+    print(f'Input bundle written to {output_file_name}')
@@ -0,0 +1,178 @@
+import numpy as np
+import sys
+from queue import Empty
+from multiprocessing import Process, Queue
+from simulation import *
+from nycuberviz import *
+
+"""Live animation, the viewer runs while the simulation is still going
+
+The simulation runs in its own process with a LivePublisher as its observer. Every driver state change is one
+(driver id, zone, status, time) row: a driver heading to a zone (status WITHOUT_PASSENGER/WITH_PASSENGER) gets
+there at time, an IDLE or OFF driver is in the zone from time on. Rows are sent in numpy batches over a bounded
+multiprocessing queue, so when the viewer falls behind, the queue fills up and the simulation waits for it.
+
+No driver histories, parquet files or pre generated positions are needed, drivers are moved straight from the updates
+"""
+
+#drivers that are off shift aren't drawn (draw_drivers only draws IDLE, WITHOUT_PASSENGER and WITH_PASSENGER)
+OFF = 3
+
+UPDATE_DTYPE = np.dtype([('driver_id', np.int32), ('zone', np.int16), ('status', np.int8), ('time', np.float32)])
+
+class LivePublisher:
+    """Observer for simulate_with_individual_drivers that puts batches of driver updates on a bounded queue
+
+       Messages are (kind, simulation time, updates) where kind is 'fleet' for the state of every driver (sent once,
+       before the first event) or 'updates', and None marks the end of the simulation
+       batch_size = max # of updates per batch, flush_interval = max simulated minutes between batches
+    """
+    def __init__(self, queue, batch_size = 4096, flush_interval = 0.25):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.updates = []
+        self.last_flush = None
+
+    def __call__(self, event, result, city):
+        if self.last_flush is None:
+            self.publish_fleet(event.time, city)
+
+        moved = set()
+        for r in (result if isinstance(result, list) else [result]):
+            if r is None:
+                continue
+            if r.type == 'Movement':
+                self.updates.append((r.driver.driver_id, r.end_zone, WITHOUT_PASSENGER, r.time))
+                moved.add(r.driver)
+            elif r.type == 'Trip':
+                self.updates.append((r.driver.driver_id, r.dropoff_zone, WITH_PASSENGER, r.time))
+                moved.add(r.driver)
+
+        #drivers that stopped moving or left without a new event
+        driver = getattr(event, 'driver', None)
+        if driver is not None and driver not in moved:
+            if city.driver_status.driver_in_status(driver, 'free'):
+                self.updates.append((driver.driver_id, driver.last_location, IDLE, event.time))
+            elif city.driver_status.driver_in_status(driver, 'inactive'):
+                self.updates.append((driver.driver_id, driver.last_location, OFF, event.time))
+
+        if len(self.updates) >= self.batch_size or event.time - self.last_flush >= self.flush_interval:
+            self.flush(event.time)
+
+    def publish_fleet(self, current_time, city):
+        fleet = []
+        for status, state in [('free', IDLE), ('inactive', OFF)]:
+            for d in city.driver_status.status[status]:
+                fleet.append((d.driver_id, d.last_location, state, current_time))
+        #blocks while the queue is full
+        self.queue.put(('fleet', current_time, np.array(fleet, dtype = UPDATE_DTYPE)))
+        self.last_flush = current_time
+
+    def flush(self, current_time):
+        if len(self.updates) > 0:
+            self.queue.put(('updates', current_time, np.array(self.updates, dtype = UPDATE_DTYPE)))
+            self.updates = []
+        self.last_flush = current_time
+
+    def close(self):
+        self.flush(self.last_flush or 0)
+        self.queue.put(None)
+
+class LiveFleet:
+    """Screen positions of the fleet, every driver moves in a straight line from where it was when its last update
+       came in to a point in the update's zone
+    """
+    def __init__(self, fleet, zone_points, rng = None):
+        self.zone_points = zone_points
+        self.rng = np.random.default_rng(rng)
+        n = fleet['driver_id'].max() + 1
+        self.start_pos = np.zeros((n, 2))
+        self.end_pos = np.zeros((n, 2))
+        self.start_time = np.zeros(n)
+        self.end_time = np.zeros(n)
+        self.states = np.full(n, OFF)
+        self.apply(fleet, fleet['time'].min() if len(fleet) > 0 else 0)
+        self.start_pos[fleet['driver_id']] = self.end_pos[fleet['driver_id']]
+
+    def positions(self, current_time):
+        duration = np.maximum(self.end_time - self.start_time, 1e-9)
+        progress = np.clip((current_time - self.start_time) / duration, 0, 1)[:, None]
+        return self.start_pos + (self.end_pos - self.start_pos) * progress
+
+    def apply(self, updates, current_time):
+        ids = updates['driver_id']
+        pools = self.zone_points[updates['zone']]
+        self.start_pos[ids] = self.positions(current_time)[ids]
+        self.end_pos[ids] = pools[np.arange(len(ids)), self.rng.integers(pools.shape[1], size = len(ids))]
+        self.start_time[ids] = current_time
+        self.end_time[ids] = np.maximum(updates['time'], current_time)
+        self.states[ids] = updates['status']
+
+def zone_point_pools(zone_dict, mode = 'random', points_per_zone = 64, rng = None):
+    """array(largest zone id + 1, points_per_zone, 2) of screen points inside every zone, zones without a polygon are off screen"""
+    rng = np.random.default_rng(rng)
+    extent_dict = {k:(v.get_extents().min, v.get_extents().max) for k,v in zone_dict.items()}
+    point_generation_function = generate_points_random if mode == 'random' else generate_points_lines
+    pools = np.full((max(max(zone_dict), 265) + 1, points_per_zone, 2), -10.0)
+    for z in zone_dict:
+        pools[z] = point_generation_function(z, points_per_zone, zone_dict = zone_dict, extent_dict = extent_dict, rng = rng)
+    return pools
+
+def run_viewer(queue, fps = 60, speed = 15, mode = 'random', seed = None):
+    """Draws the updates coming off the queue, speed = simulated minutes per second (like nycuberviz)"""
+    xy_pixel_polygons, zone_dict = create_or_load_polygon_info()
+    zone_points = zone_point_pools(zone_dict, mode, rng = seed)
+    screen, layer1, driver_sprites, font = setup_screen(xy_pixel_polygons)
+
+    kind, now, fleet_updates = queue.get()
+    fleet = LiveFleet(fleet_updates, zone_points, rng = seed)
+    pending, finished = None, False
+
+    clock = pygame.time.Clock()
+    while True:
+        clock.tick(fps)
+        handle_quit()
+
+        #apply every batch the display clock has caught up with
+        while not finished:
+            if pending is None:
+                try:
+                    pending = queue.get_nowait()
+                except Empty:
+                    break
+                if pending is None:
+                    finished = True
+                    break
+            if pending[1] > now:
+                break
+            fleet.apply(pending[2], now)
+            pending = None
+
+        #only run the clock ahead when the simulation is ahead, otherwise wait for it
+        if pending is not None or finished:
+            now += speed / fps
+
+        screen.blit(layer1, (0,0))
+        draw_drivers(screen, fleet.positions(now), fleet.states, driver_sprites)
+        draw_time(screen, font, now)
+        pygame.display.flip()
+
+def simulate_live(queue, preferred_availability, seed = None, city_options = None):
+    publisher = LivePublisher(queue)
+    simulate_replication(0, preferred_availability, seed = seed, city_options = city_options, observer = publisher)
+    publisher.close()
+
+def run_live(preferred_availability, fps = 60, speed = 15, mode = 'random', seed = None, city_options = None, queue_size = 64):
+    """Simulates one day in a separate process and animates it as it goes"""
+    queue = Queue(maxsize = queue_size)
+    simulation = Process(target = simulate_live, args = (queue, preferred_availability, seed, city_options), daemon = True)
+    simulation.start()
+    run_viewer(queue, fps, speed, mode, seed)
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (5, 6):
+        print("usage: python3 live.py {FRAMES PER SECOND} {SPEED OF SIMULATION} {FLEET SIZE} {random/lines} [{SEED}]")
+        sys.exit(1)
+    seed = int(sys.argv[5]) if len(sys.argv) == 6 else None
+    run_live(int(sys.argv[3]), int(sys.argv[1]), int(sys.argv[2]), sys.argv[4], seed)
@@ -0,0 +1,109 @@
+import pandas as pd
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+"""Memory accounting for simulation runs
+
+A MemoryProfiler passed to simulate_n_days (or simulate_replication) records the resident set size of the process at
+the end of every phase of a replication (arrival generation, schedule generation, event loop, export) and, with
+trace = True, tracemalloc snapshots of what each phase allocated, grouped by source line. Tracing slows the simulation
+down a lot, the RSS samples are basically free
+"""
+
+MB = 2 ** 20
+
+def rss_bytes():
+    """Current resident set size of the process (the peak RSS where /proc isn't available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        #ru_maxrss is in kilobytes on linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+class MemoryProfiler:
+    """Collects one record per (replication, phase) and the top allocation sites of every phase
+
+       trace = also take tracemalloc snapshots, top = # of allocation sites kept per phase,
+       frames = # of stack frames tracemalloc keeps per allocation
+       on_phase_end = optional function called with the record of every phase as soon as it ends (ex. a memory budget check)
+    """
+    def __init__(self, trace = True, top = 10, frames = 1):
+        self.trace = trace
+        self.top = top
+        self.replication = None
+        self.records = []
+        self.sites = []
+        self.started_tracing = False
+        self.on_phase_end = None
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self.started_tracing = True
+
+    def snapshot(self):
+        #leave out tracemalloc's own bookkeeping
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    @contextmanager
+    def phase(self, name):
+        before = self.snapshot() if self.trace else None
+        if self.trace:
+            tracemalloc.reset_peak()
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {'replication': self.replication, 'phase': name, 'seconds': time.perf_counter() - tic, 'rss_mb': rss_bytes() / MB}
+            if self.trace:
+                current, peak = tracemalloc.get_traced_memory()
+                record.update({'traced_mb': current / MB, 'peak_traced_mb': peak / MB})
+                for stat in self.snapshot().compare_to(before, 'lineno')[:self.top]:
+                    frame = stat.traceback[0]
+                    self.sites.append({'replication': self.replication,
+                                       'phase': name,
+                                       'site': f'{os.path.basename(frame.filename)}:{frame.lineno}',
+                                       'size_diff_mb': stat.size_diff / MB,
+                                       'size_mb': stat.size / MB,
+                                       'count_diff': stat.count_diff})
+            self.records.append(record)
+            if self.on_phase_end is not None:
+                self.on_phase_end(record)
+
+    def phase_report(self):
+        """dataframe of every (replication, phase) record"""
+        return pd.DataFrame(self.records)
+
+    def top_sites(self, replication = None):
+        """dataframe of the allocation sites that grew the most in every phase (of one replication or all of them)"""
+        sites = pd.DataFrame(self.sites, columns = ['replication', 'phase', 'site', 'size_diff_mb', 'size_mb', 'count_diff'])
+        if replication is not None:
+            sites = sites[sites.replication == replication]
+        return sites.sort_values('size_diff_mb', ascending = False).reset_index(drop = True)
+
+    def format_replication(self, replication, sites = 5):
+        s = f'Memory (replication {replication}):'
+        for r in self.records:
+            if r['replication'] == replication:
+                s += f"\n\t{r['phase']:<20} RSS {r['rss_mb']:9.1f} MB"
+                if 'traced_mb' in r:
+                    s += f"   traced {r['traced_mb']:9.1f} MB (peak {r['peak_traced_mb']:.1f} MB)"
+        if self.trace:
+            s += '\n\tTop allocation sites:'
+            top = sorted((site for site in self.sites if site['replication'] == replication), key = lambda site: -site['size_diff_mb'])
+            for site in top[:sites]:
+                s += f"\n\t{site['phase']:<20} {site['site']:<32} {site['size_diff_mb']:+9.1f} MB ({site['count_diff']:+d} blocks)"
+        return s
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+def profile_phase(profiler, name):
+    """profiler.phase(name), or a context that does nothing when there's no profiler"""
+    return profiler.phase(name) if profiler is not None else nullcontext()
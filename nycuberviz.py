@@ -1,4 +1,5 @@
 import sys, pygame
+import numpy as np
 from DriverAnimation import DriverAnimation
 from generate_polygon_info import *
 from generate_positions import *
@@ -7,24 +8,6 @@ from generate_positions import *
 
 #changing the screen size argument messes with everything don't do it
 SCREEN_SIZE = (1200,800)
-if len(sys.argv) == 5:
-	FPS = int(sys.argv[1])
-	SPEED_OF_SIM = int(sys.argv[2])
-	FOLDER = sys.argv[3]
-	MODE = sys.argv[4]
-else:
-	FOLDER = input('Enter test folder name:')
-	FPS = int(input('Enter FPS: '))
-	SPEED_OF_SIM = int(input('Enter the speed of the simulation: '))
-	MODE = input('Mode (random/lines): ')
-
-DRIVER_MOVEMENT_FILENAME = f'output/{FOLDER}/driver_histories_parquet'
-
-xy_pixel_polygons, zone_dict = create_or_load_polygon_info()
-
-driver_generated_points = generate_positions(DRIVER_MOVEMENT_FILENAME, zone_dict, FOLDER, mode = MODE)
-
-driver_animations = DriverAnimation(driver_generated_points, SPEED_OF_SIM, FPS)
 
 """Draws the backround of the pygame set"""
 def draw_bg(poly_list, s):
@@ -37,51 +20,114 @@ def load_image(image_path, size = (3,3), alpha = 200):
 	im = pygame.transform.scale(im, size).convert_alpha()
 	im.set_alpha(alpha)
 	return im
-		
-#initalize screen and stuff
-pygame.init()
-size = width, height = SCREEN_SIZE
-screen = pygame.display.set_mode(size)
-
-driver_with_passenger = load_image('viz/passenger.png', alpha = 200)
-driver_without_passenger = load_image('viz/nopassenger.png', alpha = 150)
-driver_idle = load_image('viz/idle.png', alpha = 20)
-
-driver_rectangles = [driver_without_passenger.get_rect() for i in range(driver_animations.driver_count)]
 
-"""Bottom Layer with all the city boundaries drawn on"""
-layer1 = pygame.Surface(SCREEN_SIZE)
-layer1.fill([225,225,225])
-draw_bg(xy_pixel_polygons, layer1)
-
-clock = pygame.time.Clock()
-font = pygame.font.SysFont('Trebuchet MS', 20)
-while True:
-	clock.tick(FPS)
+"""Driver states, drawn in this order so that drivers with passengers end up on top"""
+IDLE, WITHOUT_PASSENGER, WITH_PASSENGER = 0, 1, 2
+
+"""Collapses the masks returned by DriverAnimation.update into one state per driver"""
+def driver_states(is_moving, has_pass, finished):
+	states = np.where(np.asarray(is_moving, dtype = bool), WITHOUT_PASSENGER, IDLE)
+	states[np.asarray(has_pass, dtype = bool)] = WITH_PASSENGER
+	states[np.asarray(finished, dtype = bool)] = IDLE
+	return states
+
+"""Pixels of a sprite as (x offsets, y offsets from its center, colors array(pixels, 3), opacities array(pixels))"""
+def sprite_pixels(sprite):
+	w, h = sprite.get_size()
+	xs, ys = np.meshgrid(np.arange(w) - w // 2, np.arange(h) - h // 2, indexing = 'ij')
+	#surface alpha (set_alpha) and per pixel alpha multiply when the sprite is blitted
+	opacity = pygame.surfarray.array_alpha(sprite).astype(np.float32) * (sprite.get_alpha() or 255) / 255 ** 2
+	visible = (opacity > 0).ravel()
+	return xs.ravel()[visible], ys.ravel()[visible], pygame.surfarray.array3d(sprite).reshape((-1, 3))[visible].astype(np.float32), opacity.ravel()[visible]
+
+"""Draws every driver by alpha blending its sprite straight into the screen pixels (pygame.surfarray), one numpy
+   operation per state instead of one blit per driver. Where drivers of the same state overlap, the pixel is blended once
+"""
+def draw_drivers(s, centers, states, sprites):
+	width, height = s.get_size()
+	centers = np.asarray(centers).astype(int)
+	pixels = pygame.surfarray.pixels3d(s)
+	for state in (IDLE, WITHOUT_PASSENGER, WITH_PASSENGER):
+		dx, dy, colors, opacity = sprite_pixels(sprites[state])
+		drawn = centers[states == state]
+		xs = (drawn[:, 0, None] + dx).ravel()
+		ys = (drawn[:, 1, None] + dy).ravel()
+		on_screen = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+		xs, ys = xs[on_screen], ys[on_screen]
+		opacity = np.tile(opacity, len(drawn))[on_screen, None]
+		colors = np.tile(colors, (len(drawn), 1))[on_screen]
+		pixels[xs, ys] = (pixels[xs, ys] * (1 - opacity) + colors * opacity).astype(np.uint8)
+	#the screen stays locked while the pixel array exists
+	del pixels
+
+"""Opens the window, returns (screen, background layer with the city boundaries, driver sprites, font)"""
+def setup_screen(xy_pixel_polygons):
+	pygame.init()
+	screen = pygame.display.set_mode(SCREEN_SIZE)
+
+	driver_with_passenger = load_image('viz/passenger.png', alpha = 200)
+	driver_without_passenger = load_image('viz/nopassenger.png', alpha = 150)
+	driver_idle = load_image('viz/idle.png', alpha = 20)
+
+	driver_sprites = {IDLE: driver_idle, WITHOUT_PASSENGER: driver_without_passenger, WITH_PASSENGER: driver_with_passenger}
+
+	"""Bottom Layer with all the city boundaries drawn on"""
+	layer1 = pygame.Surface(SCREEN_SIZE)
+	layer1.fill([225,225,225])
+	draw_bg(xy_pixel_polygons, layer1)
+
+	font = pygame.font.SysFont('Trebuchet MS', 20)
+	return screen, layer1, driver_sprites, font
+
+"""Display a system time counter"""
+def draw_time(s, font, curr_time):
+	time_font = font.render('Time: {hour:02}:{minute:02}'.format(hour = round(curr_time//60), minute = round(curr_time%60)), 1, (0,0,0))
+	time_rect = time_font.get_rect()
+	time_rect.center = (60,40)
+	s.blit(time_font, time_rect)
 
+"""Quits if the window was closed"""
+def handle_quit():
 	for event in pygame.event.get():
 		if event.type == pygame.QUIT:
 			pygame.quit()
 			quit()
 
-	screen.blit(layer1, (0,0))
-	"""Updates the position of each driver according to the current animation"""
-	centers, is_moving, has_pass, finished, curr_time = driver_animations.update()
-	for c, i, h, f, rect in zip(centers, is_moving, has_pass, finished, driver_rectangles):
-		rect.center = c
-		if f:
-			screen.blit(driver_idle, rect)
-		elif h:
-			screen.blit(driver_with_passenger, rect)
-		elif i:
-			screen.blit(driver_without_passenger, rect)
-		else:
-			screen.blit(driver_idle, rect)
-
-	"""Display a system time counter"""
-	time_font = font.render('Time: {hour:02}:{minute:02}'.format(hour = round(curr_time//60), minute = round(curr_time%60)), 1, (0,0,0))
-	time_rect = time_font.get_rect()
-	time_rect.center = (60,40)
-	screen.blit(time_font, time_rect)
+def main(argv):
+	if len(argv) == 5:
+		FPS = int(argv[1])
+		SPEED_OF_SIM = int(argv[2])
+		FOLDER = argv[3]
+		MODE = argv[4]
+	else:
+		FOLDER = input('Enter test folder name:')
+		FPS = int(input('Enter FPS: '))
+		SPEED_OF_SIM = int(input('Enter the speed of the simulation: '))
+		MODE = input('Mode (random/lines): ')
+
+	DRIVER_MOVEMENT_FILENAME = f'output/{FOLDER}/driver_histories_parquet'
+
+	xy_pixel_polygons, zone_dict = create_or_load_polygon_info()
+
+	driver_generated_points = generate_positions(DRIVER_MOVEMENT_FILENAME, zone_dict, FOLDER, mode = MODE)
+
+	driver_animations = DriverAnimation(driver_generated_points, SPEED_OF_SIM, FPS)
+
+	#initalize screen and stuff
+	screen, layer1, driver_sprites, font = setup_screen(xy_pixel_polygons)
+
+	clock = pygame.time.Clock()
+	while True:
+		clock.tick(FPS)
+		handle_quit()
+
+		screen.blit(layer1, (0,0))
+		"""Updates the position of each driver according to the current animation"""
+		centers, is_moving, has_pass, finished, curr_time = driver_animations.update()
+		draw_drivers(screen, centers, driver_states(is_moving, has_pass, finished), driver_sprites)
+		draw_time(screen, font, curr_time)
+
+		pygame.display.flip()
 
-	pygame.display.flip()
\ No newline at end of file
+if __name__ == '__main__':
+	main(sys.argv)
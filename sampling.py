@@ -0,0 +1,60 @@
+import numpy as np
+
+def build_alias_row(probabilities):
+    """Vose's method for one distribution, returns (acceptance probabilities, aliases)"""
+    n = len(probabilities)
+    scaled = (np.asarray(probabilities, dtype = float) * n / np.sum(probabilities)).tolist()
+    accept = [1.0] * n
+    alias = list(range(n))
+
+    small = [i for i, s in enumerate(scaled) if s < 1]
+    large = [i for i, s in enumerate(scaled) if s >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        accept[s] = scaled[s]
+        alias[s] = l
+        #the large outcome gives up the probability mass it lends to the small one
+        scaled[l] = scaled[l] + scaled[s] - 1
+        if scaled[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+
+    #whatever is left over is (up to rounding) exactly 1, so it always accepts itself
+    return np.array(accept), np.array(alias)
+
+class AliasTable:
+    """Walker alias tables for a stack of discrete distributions over the same outcomes (one per row)
+
+    Built once, each draw is then one uniform column pick plus one coin flip, so draws for any mix of
+    rows (ex. every arrival of a day, each with its own pickup zone) are made in a single vectorized call
+    """
+
+    def __init__(self, probabilities, outcomes = None):
+        probabilities = np.atleast_2d(np.asarray(probabilities, dtype = float))
+        rows, n = probabilities.shape
+        self.outcomes = np.arange(n) if outcomes is None else np.asarray(outcomes)
+        self.accept = np.ones((rows, n))
+        self.alias = np.zeros((rows, n), dtype = np.int64)
+        for r in range(rows):
+            self.accept[r], self.alias[r] = build_alias_row(probabilities[r])
+
+    def sample(self, rows, rng = None):
+        """Draws one outcome for every entry of rows (row positions, not zone ids)"""
+        rng = np.random.default_rng(rng)
+        rows = np.asarray(rows, dtype = np.int64)
+        columns = rng.integers(self.accept.shape[1], size = rows.shape)
+        keep = rng.uniform(size = rows.shape) < self.accept[rows, columns]
+        return self.outcomes[np.where(keep, columns, self.alias[rows, columns])]
+
+"""Randomness of a replication is split into independent streams, so changing how one part of the system
+   draws numbers (ex. a new dispatch policy changing travel times) doesn't shift the others
+"""
+STREAM_NAMES = ['demand', 'supply', 'travel']
+
+def replication_streams(seed, replication):
+    """Generators for the demand (arrivals), supply (driver schedules) and travel (movement times) of one replication
+       Only depends on (seed, replication), so replications can be run in any order or process
+    """
+    replication_seed = np.random.SeedSequence(seed, spawn_key = (replication,))
+    return {name: np.random.default_rng(s) for name, s in zip(STREAM_NAMES, replication_seed.spawn(len(STREAM_NAMES)))}
@@ -0,0 +1,385 @@
+import pandas as pd
+import numpy as np
+import sys
+import time
+from multiprocessing import Process, Pipe
+from collections import defaultdict
+from simulation import *
+
+"""Spatially sharded simulation, one process per group of zones
+
+The zones are split into shards (clusters of zones that are close to each other in the OD matrix, or any given grouping
+like boroughs) and every shard runs its own ShardCity and EventList in a separate process. The shards advance together
+in windows of simulated time: within a window they don't talk to each other, and at the end of every window a
+coordinator exchanges their messages
+
+    - handovers: a driver whose next event (the end of a Movement or a Trip) is in another shard's zone moves to that
+      shard together with the event and its pending shift arrival/departure events
+    - dispatch requests: a passenger that arrives in a shard without free drivers is offered to the free drivers of
+      every shard (closest zone by mean time first), and is held in its own shard if there are none
+
+This is conservative synchronisation: the window length (the lookahead) is the smallest OD 'min' time between zones in
+different shards, never less than min_lookahead. Cross shard movements and trips are never shorter than the window,
+so everything a shard sends happens after the window ends and no shard ever receives an event from its past.
+The approximations are that cross shard movements/trips shorter than the window are stretched to it, and a dispatch
+request waits for the end of its window
+"""
+
+def filled_mean_times(od_stats, geometry = None):
+    """Mean movement time between every pair of zones, unobserved pairs get the time estimated from the zone geometry
+       tables or without them the weighted mean time into the dropoff zone (or out of the pickup zone), like City does
+    """
+    means, counts = od_stats[:, :, 0], od_stats[:, :, 4]
+    if geometry is not None:
+        return np.where(counts > 0, means, geometry['fallback_times'])
+    totals = (means * counts).sum(axis = 0)
+    into = np.divide(totals, counts.sum(axis = 0), out = np.full(len(totals), np.nan), where = counts.sum(axis = 0) > 0)
+    out_of = np.divide((means * counts).sum(axis = 1), counts.sum(axis = 1), out = np.full(len(totals), np.nan), where = counts.sum(axis = 1) > 0)
+    defaults = np.where(np.isnan(into), out_of, into)
+    defaults = np.where(np.isnan(defaults), np.nanmean(defaults), defaults)
+    return np.where(counts > 0, means, defaults[None, :])
+
+def cluster_zones(mean_times, weights, shards, iterations = 50):
+    """Splits zones into shards with k-medoids on the symmetric mean times, medoids are weighted by demand
+       returns the shard of every zone (array positions are zone_id - 1)
+    """
+    distances = (mean_times + mean_times.T) / 2
+    #start from the busiest zone and keep adding the zone that is (demand weighted) farthest from every medoid
+    medoids = [int(np.argmax(weights))]
+    while len(medoids) < shards:
+        medoids.append(int(np.argmax(distances[:, medoids].min(axis = 1) * weights)))
+
+    labels = np.argmin(distances[:, medoids], axis = 1)
+    for i in range(iterations):
+        for k in range(shards):
+            members = np.flatnonzero(labels == k)
+            costs = (distances[np.ix_(members, members)] * weights[members][None, :]).sum(axis = 1)
+            medoids[k] = int(members[np.argmin(costs)])
+        new_labels = np.argmin(distances[:, medoids], axis = 1)
+        if (new_labels == labels).all():
+            break
+        labels = new_labels
+    return labels
+
+def shard_lookahead(owner, od_stats, zone_ids, min_lookahead = 1.0):
+    """(smallest observed OD min time between zones of different shards, window length actually used)"""
+    shard_of = owner[zone_ids]
+    cross = (shard_of[:, None] != shard_of[None, :]) & (od_stats[:, :, 4] > 0)
+    lookahead = od_stats[:, :, 2][cross].min() if cross.any() else np.inf
+    return lookahead, max(lookahead, min_lookahead)
+
+class ShardCity(City):
+    """City that owns the zones of one shard, drivers leaving them are handed over to the shard they're going to
+
+       owner = array of the shard of every zone id, lookahead = the window length (min time of any cross shard event)
+    """
+    def __init__(self, shard, owner, lookahead, zone_ids, drivers, odmatrix, passengers, rng = None, **city_options):
+        City.__init__(self, f'NYC shard {shard}', zone_ids, drivers, odmatrix, passengers, rng = rng, **city_options)
+        self.shard = shard
+        self.owner = owner
+        self.lookahead = lookahead
+        self.window_end = 0
+        self.event_list = None
+        #pending DriverArrival/DriverDeparture events of every driver, they move with the driver between shards
+        self.schedule_events = {}
+        self.outbox = {'handovers': [], 'requests': []}
+        #movement history recorded here by drivers that were handed over, (driver id, # of handovers before it, segments)
+        self.history_pieces = []
+
+    def generate_movement_time(self, pu, do):
+        m = City.generate_movement_time(self, pu, do)
+        if self.owner[pu] != self.owner[do]:
+            #cross shard movements can't end inside the current window
+            m = max(m, self.lookahead)
+        return m
+
+    def hold_passenger(self, passenger):
+        #no free driver in this shard, offer the passenger to the other shards at the end of the window
+        if self.owner.max() == 0:
+            return City.hold_passenger(self, passenger)
+        self.outbox['requests'].append(passenger)
+
+    def depart_driver(self, driver):
+        City.depart_driver(self, driver)
+        #a driver that comes back later starts from its start zone, which can belong to another shard
+        if self.owner[driver.start_zone] != self.shard and any(e.scheduled for e in self.schedule_events.get(driver, [])):
+            self.hand_over(driver, None, self.owner[driver.start_zone])
+
+    def route(self, result):
+        """Inserts new events into the local event list, or hands their driver over if they end in another shard"""
+        for r in (result if isinstance(result, list) else [result]):
+            if r is None:
+                continue
+            zone = r.end_zone if r.type == 'Movement' else r.dropoff_zone if r.type == 'Trip' else None
+            if zone is not None and self.owner[zone] != self.shard:
+                self.hand_over(r.driver, r, self.owner[zone])
+            else:
+                self.event_list.insert_event(r)
+
+    def hand_over(self, driver, event, shard):
+        for status in ('busy', 'max_queue', 'marked_for_departure', 'inactive'):
+            if self.driver_status.driver_in_status(driver, status):
+                self.driver_status.status[status].remove(driver)
+                break
+        self.busy_drivers.remove(driver)
+
+        schedule_events = [e for e in self.schedule_events.pop(driver, []) if e.scheduled]
+        for e in schedule_events:
+            self.event_list.cancel(e)
+            #a shift change due during this window happens at the start of the next one in the new shard
+            e.time = max(e.time, self.window_end)
+        #only the dispatch state travels, the history recorded so far stays here (results() sends it once at the end)
+        self.history_pieces.append((driver.driver_id, driver.handovers, driver.movement_history))
+        driver.movement_history = []
+        driver.handovers += 1
+        self.outbox['handovers'].append((shard, driver, status, event, schedule_events))
+
+    def receive_driver(self, driver, status, event, schedule_events):
+        self.driver_status.add_driver(driver, status)
+        if event is not None:
+            self.event_list.insert_event(event)
+            if event.type == 'Movement':
+                #the passenger being picked up is still at the front of the queue
+                head = driver.passenger_queue[0]
+                self.index_busy_driver(driver, event.time + self.passengers.service[head], self.passengers.end[head], 1)
+            else:
+                self.index_busy_driver(driver, event.time, event.dropoff_zone)
+        for e in schedule_events:
+            self.event_list.insert_event(e)
+        self.schedule_events[driver] = schedule_events
+
+    def receive(self, current_time, inbox):
+        """Applies the messages of the last barrier at the start of a window"""
+        for driver, status, event, schedule_events in inbox['handovers']:
+            self.receive_driver(driver, status, event, schedule_events)
+        for passenger, zone in inbox['dispatches']:
+            self.route(self.send_free_driver(current_time, self.zones.get_driver(zone), passenger))
+        for passenger in inbox['returned']:
+            #no free driver anywhere, queue on a busy driver of this shard or wait
+            City.hold_passenger(self, passenger)
+
+    def collect_outbox(self):
+        outbox = self.outbox
+        outbox['supply'] = {z: len(drivers) for z, drivers in self.zones.zones.items() if len(drivers) > 0}
+        outbox['next_time'] = self.event_list.next_event_time()
+        self.outbox = {'handovers': [], 'requests': []}
+        return outbox
+
+    def results(self):
+        departed = np.flatnonzero(~np.isnan(self.passengers.departure_time))
+        drivers = [d for status in self.driver_status.status.values() for d in status]
+        return departed, self.passengers.departure_time[departed], drivers, self.history_pieces
+
+def empty_inbox():
+    return {'handovers': [], 'dispatches': [], 'returned': []}
+
+def run_shard(conn, shard, owner, lookahead, arrival_data, drivers, odmatrix, rng, city_options):
+    """Shard process: runs one window per message from the coordinator until it gets None"""
+    passengers = PassengerTable(arrival_data)
+    zone_ids = np.sort(odmatrix.index.get_level_values(0).unique())
+    city = ShardCity(shard, owner, lookahead, zone_ids, drivers, odmatrix, passengers, rng = rng, **(city_options or {}))
+
+    #only the passengers picked up in this shard's zones arrive here
+    initial_events = [Arrival(passengers.time[p], p) for p in np.flatnonzero(owner[np.array(passengers.start)] == shard)]
+    for d in drivers:
+        city.schedule_events[d] = [DriverArrival(d), DriverDeparture(d)]
+        initial_events.extend(city.schedule_events[d])
+    event_list = EventList(initial_events)
+    city.event_list = event_list
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        window_start, window_end, inbox = message
+        city.window_end = window_end
+        city.receive(window_start, inbox)
+        #relies on the event list being in time order, everything before window_end runs in this window
+        while event_list.next_event_time() < window_end:
+            event = event_list.iterate_next_event()
+            if event.time < window_start:
+                raise RuntimeError(f'Shard {shard} got an event at {event.time} in the window starting at {window_start}')
+            city.route(city.process_event(event))
+        conn.send(city.collect_outbox())
+    conn.send(city.results())
+    conn.close()
+
+def simulate_sharded(arrivals,
+                     preferred_driver_availability,
+                     shards = 4,
+                     odmatrix = None,
+                     pickup_data = None,
+                     supply_rng = None,
+                     travel_rng = None,
+                     city_options = None,
+                     min_lookahead = 1.0):
+    """Same inputs as simulate_with_individual_drivers, returns (passengers, drivers, report)
+
+       shards = # of shards to cluster the zones into, or a list of lists of zone ids (ex. the zones of each borough)
+       report = dictionary describing the partition and the message traffic
+    """
+    supply_rng = np.random.default_rng(supply_rng)
+    travel_rng = np.random.default_rng(travel_rng)
+    if odmatrix is None:
+        odmatrix = load_trip_time_data()
+    if pickup_data is None:
+        pickup_data = load_hourly_arrival_rate()
+
+    zone_ids = np.sort(odmatrix.index.get_level_values(0).unique())
+    od_stats = od_stats_array(odmatrix, zone_ids)
+    city_options = with_zone_geometry(city_options, odmatrix, zone_ids)
+    mean_times = filled_mean_times(od_stats, city_options.get('geometry'))
+
+    #shard of every zone id
+    owner = np.full(zone_ids.max() + 1, -1)
+    if isinstance(shards, int):
+        weights = pickup_data.sum(axis = 1).reindex(zone_ids, fill_value = 0).values + 1
+        owner[zone_ids] = cluster_zones(mean_times, weights, shards)
+    else:
+        for shard, zones in enumerate(shards):
+            owner[np.asarray(zones, dtype = int)] = shard
+    if (owner[zone_ids] < 0).any():
+        raise ValueError('Every zone of the OD matrix has to belong to a shard')
+    shard_count = owner.max() + 1
+    lookahead, window = shard_lookahead(owner, od_stats, zone_ids, min_lookahead)
+
+    #trips between shards take at least one window (the service time is what the waiting time is measured against)
+    arrival_data = arrivals.values.astype(float)
+    starts, ends = arrival_data[:, 1].astype(int), arrival_data[:, 2].astype(int)
+    cross = owner[starts] != owner[ends]
+    arrival_data[cross, 3] = np.maximum(arrival_data[cross, 3], window)
+    passengers = PassengerTable(arrival_data)
+
+    drivers = create_drivers(preferred_driver_availability, zone_ids, pickup_data, supply_rng)
+    shard_drivers = [[] for s in range(shard_count)]
+    for d in drivers:
+        shard_drivers[owner[d.start_zone]].append(d)
+        #orders the pieces of a driver's history recorded in different shards
+        d.handovers = 0
+
+    connections, processes = [], []
+    #Generator.spawn needs numpy >= 1.25, seed the shards from a SeedSequence instead
+    for s, shard_seed in enumerate(np.random.SeedSequence(travel_rng.integers(2 ** 63)).spawn(shard_count)):
+        rng = np.random.default_rng(shard_seed)
+        parent_conn, child_conn = Pipe()
+        p = Process(target = run_shard, args = (child_conn, s, owner, window, arrival_data, shard_drivers[s], odmatrix, rng, city_options), daemon = True)
+        p.start()
+        connections.append(parent_conn)
+        processes.append(p)
+
+    report = {'shards': shard_count,
+              'zones_per_shard': np.bincount(owner[zone_ids]).tolist(),
+              'drivers_per_shard': [len(d) for d in shard_drivers],
+              'lookahead': lookahead,
+              'window': window,
+              'windows': 0,
+              'handovers': 0,
+              'remote_dispatches': 0,
+              'returned_requests': 0}
+
+    current_time = 0
+    inboxes = [empty_inbox() for s in range(shard_count)]
+    pbar = tqdm(total = 1440, position = 0, leave = True, desc = 'Simulated Minutes')
+    while True:
+        window_end = current_time + window
+        for conn, inbox in zip(connections, inboxes):
+            conn.send((current_time, window_end, inbox))
+        outboxes = [conn.recv() for conn in connections]
+        report['windows'] += 1
+
+        inboxes = [empty_inbox() for s in range(shard_count)]
+        for outbox in outboxes:
+            for shard, *handover in outbox['handovers']:
+                inboxes[shard]['handovers'].append(handover)
+                report['handovers'] += 1
+
+        #offer the passengers without a free driver in their shard to the closest free drivers anywhere, oldest first
+        requests = sorted((p for outbox in outboxes for p in outbox['requests']), key = lambda p: passengers.time[p])
+        supply = {z: c for outbox in outboxes for z, c in outbox['supply'].items()}
+        supply_zones = np.array(list(supply), dtype = int)
+        supply_counts = np.array(list(supply.values()), dtype = int)
+        for p in requests:
+            pickup_zone = passengers.start[p]
+            if supply_counts.sum() == 0:
+                inboxes[owner[pickup_zone]]['returned'].append(p)
+                report['returned_requests'] += 1
+                continue
+            times = np.where(supply_counts > 0, mean_times[supply_zones - 1, pickup_zone - 1], np.inf)
+            i = np.argmin(times)
+            supply_counts[i] -= 1
+            inboxes[owner[supply_zones[i]]]['dispatches'].append((p, supply_zones[i]))
+            report['remote_dispatches'] += owner[supply_zones[i]] != owner[pickup_zone]
+
+        pending = any(len(inbox[kind]) > 0 for inbox in inboxes for kind in inbox)
+        next_time = min(outbox['next_time'] for outbox in outboxes)
+        if not pending and next_time == np.inf:
+            break
+        #with nothing in flight, skip straight to the next event
+        new_time = window_end if pending else max(window_end, next_time)
+        pbar.update(max(min(new_time, 1440) - min(current_time, 1440), 0))
+        current_time = new_time
+    pbar.close()
+
+    final_drivers = []
+    history_pieces = []
+    for conn, p in zip(connections, processes):
+        conn.send(None)
+        departed, departure_times, shard_fleet, shard_pieces = conn.recv()
+        passengers.departure_time[departed] = departure_times
+        final_drivers.extend(shard_fleet)
+        history_pieces.extend(shard_pieces)
+        p.join()
+    final_drivers.sort(key = lambda d: d.driver_id)
+
+    #stitch every driver's history back together, the pieces left behind at each handover come before what it has now
+    pieces = defaultdict(list)
+    for driver_id, handovers, history in history_pieces:
+        pieces[driver_id].append((handovers, history))
+    for d in final_drivers:
+        d.movement_history = [h for handovers, history in sorted(pieces[d.driver_id], key = lambda piece: piece[0]) for h in history] + d.movement_history
+    return passengers, final_drivers, report
+
+def simulate_replication_sharded(i,
+                                 preferred_availability,
+                                 shards = 4,
+                                 seed = None,
+                                 inputs = None,
+                                 city_options = None,
+                                 min_lookahead = 1.0):
+    """simulate_replication on the sharded engine, returns (passenger dataframe, drivers, report)"""
+    inputs = inputs or {}
+    print(f'--- Day {i} ({shards} shards) ---')
+    streams = replication_streams(seed, i)
+    arrivals = generate_arrivals_per_zone(inputs.get('hourly_arrival_rate'),
+                                          inputs.get('dropoff_frequency'),
+                                          inputs.get('trip_time_data'),
+                                          show_progress_bar = True,
+                                          rng = streams['demand'],
+                                          dropoff_table = inputs.get('dropoff_table'))
+    p, d, report = simulate_sharded(arrivals,
+                                    preferred_availability,
+                                    shards = shards,
+                                    odmatrix = inputs.get('trip_time_data'),
+                                    pickup_data = inputs.get('hourly_arrival_rate'),
+                                    supply_rng = streams['supply'],
+                                    travel_rng = streams['travel'],
+                                    city_options = city_options,
+                                    min_lookahead = min_lookahead)
+    waiting_times = p.return_passenger_dataframe()
+    waiting_times['arrival_hour'] = waiting_times.arrival_time//60
+    waiting_times['replication'] = i
+
+    print(f'Average Waiting Time: {waiting_times.waiting_time.mean()}')
+    print(f'Median Waiting Time: {np.median(waiting_times.waiting_time)}')
+    print(f'Shards: {report} \n --- End of Day {i} ---\n')
+    return waiting_times, d, report
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print("usage: python3 sharded.py {# SHARDS} {FLEET SIZE} [{SEED}]")
+        sys.exit(1)
+    seed = np.random.SeedSequence(int(sys.argv[3]) if len(sys.argv) == 4 else None).entropy
+    print(f'Seed: {seed}')
+    tic = time.time()
+    simulate_replication_sharded(0, int(sys.argv[2]), shards = int(sys.argv[1]), seed = seed)
+    print(f'Total time: {time.time() - tic:.1f}s')
@@ -0,0 +1,541 @@
+import pandas as pd
+import numpy as np
+from tqdm import tqdm
+from joblib import load
+from functools import lru_cache
+from input_bundle import *
+import zone_geometry
+from sampling import *
+from city_elements import *
+from city import *
+from event_list import *
+from memory_profile import *
+import os
+
+"""The input datasets are only read the first time they are needed and then memoized for the rest of the process,
+   so importing this module (from a worker, a notebook or a test) doesn't touch the disk
+"""
+@lru_cache(maxsize = None)
+def load_input_bundle():
+    """Arrays from the compiled input bundle (python3 input_bundle.py), None if it's missing or out of date"""
+    if bundle_is_current():
+        return read_bundle(DEFAULT_BUNDLE_PATH)[0]
+    return None
+
+@lru_cache(maxsize = None)
+def load_pickup_data():
+    """Series of (hourly arrival rates, dropoff counts) tuples indexed by pickup zone"""
+    return pd.read_pickle(os.path.join(INPUT_DIR, 'arrival_and_dropoff_distributions'))
+
+@lru_cache(maxsize = None)
+def load_hourly_arrival_rate():
+    if load_input_bundle() is not None:
+        return hourly_arrival_rate_frame(load_input_bundle())
+    return load_pickup_data().apply(lambda item: item[0])
+
+@lru_cache(maxsize = None)
+def load_dropoff_frequency():
+    if load_input_bundle() is not None:
+        return dropoff_frequency_frame(load_input_bundle())
+    return load_pickup_data().apply(lambda item: item[1] / item[1].sum())
+
+@lru_cache(maxsize = None)
+def load_trip_time_data():
+    if load_input_bundle() is not None:
+        return trip_time_frame(load_input_bundle())
+    return pd.read_parquet(os.path.join(INPUT_DIR, 'trip_time_means'))
+
+@lru_cache(maxsize = None)
+def load_minimum_active_trips():
+    if load_input_bundle() is not None:
+        return pd.DataFrame({'Driver Count': load_input_bundle()['availability']})
+    return load(os.path.join(INPUT_DIR, 'minimum_active_uber_trips'))
+
+@lru_cache(maxsize = None)
+def load_zone_geometry():
+    """(arrays, metadata) of the zone geometry tables, built on first use (see zone_geometry.py)"""
+    return zone_geometry.load_zone_geometry()
+
+@lru_cache(maxsize = None)
+def load_od_fingerprint():
+    """zone_geometry.od_fingerprint of the real trip time data"""
+    trip_time_data = load_trip_time_data()
+    return zone_geometry.od_fingerprint(od_stats_array(trip_time_data, np.sort(trip_time_data.index.get_level_values(0).unique())))
+
+@lru_cache(maxsize = None)
+def load_dropoff_alias_table():
+    """Alias tables for every zone's dropoff distribution, rows in the same order as load_dropoff_frequency()"""
+    return dropoff_alias_table(load_dropoff_frequency())
+
+def dropoff_alias_table(zone_dropoff_frequencies):
+    return AliasTable(zone_dropoff_frequencies.values, outcomes = zone_dropoff_frequencies.columns.values)
+
+def generate_bundle(size = 1000, rng = None):
+    """Generates uniform centers of intervals (each interval represents a driver schedule
+       Generates intervals of lengths centered around 8 hours with min/max of 2/10
+    """
+    rng = np.random.default_rng(rng)
+    centers = rng.integers(1440, size = size)
+
+    #weights 8 hour intervals higher than 2 hours or 10 hours
+    possible_lengths = np.arange(60, 301) * 2
+    length_pvalues = 1/(np.abs(480 - possible_lengths) + 15)
+    length_pvalues = length_pvalues / length_pvalues.sum()
+    lengths = rng.choice(possible_lengths, size = size, p = length_pvalues)
+    lengths.sort()
+    #the sort is so that when we iteratively add them to the driver list we add the highest values first
+    return centers, lengths[::-1]
+
+def update_availability_arr(availability, bundle, preferred_availability, acceptable_overlap = 60, show_progress = False):
+    """Updates the available drivers using the bundle of given intervals"""
+    mins = bundle[0] - bundle[1] / 2
+    mins = np.where(mins >= 0, mins, 1440 + mins)
+    maxs = bundle[0] + bundle[1] / 2
+    maxs = np.where(maxs < 1440, maxs, maxs - 1440)
+    bounds = np.c_[mins, maxs].astype(int)
+
+    #transform bounds to np array (1440)
+    #and iteratively add if it's okay to add
+    updated_avail = availability
+    accepted_drivers = []
+    if show_progress:
+        iterable_shown = tqdm(range(len(bounds)), position = 0, leave = True, desc = 'Transforming bounds to arrays')
+    else:
+        iterable_shown = range(len(bounds))
+    for i in iterable_shown:
+        new_arr = np.zeros(1440)
+        s, e = bounds[i][0], bounds[i][1]
+        if e < s:
+            new_arr[s:] = 1
+            new_arr[:e] = 1
+        else:
+            new_arr[s:e] = 1
+        restricted = (preferred_availability - updated_avail <= 0).astype(int)
+        if (new_arr + restricted == 2).sum() <= acceptable_overlap:
+            accepted_drivers.append(i)
+            updated_avail += new_arr
+                        
+    #filter out the bounded_arr
+    diff = (updated_avail - preferred_availability)
+    return updated_avail, diff, bounds[accepted_drivers]
+
+"""Tolerated_under_preferred -> maximum difference between 
+the number of generated drivers at any minute and the number of preferred drivers at any minute
+
+Acceptable_overlap -> the number of minutes that can be overlapped when adding a driver to the generated driver list
+
+chunk_size -> number of driver schedules generated at once
+
+rng -> np.random.Generator (or a seed) the schedules are drawn from
+"""
+def generate_driver_schedules(preferred_availability, 
+    tolerated_under_preferred = 3000, 
+    acceptable_overlap = 60, 
+    chunk_size = 100000,
+    show_progress = False,
+    rng = None):
+    """Given a few parameters, generate driver schedules until some acceptable threshold is met for the given
+       preferred availability function
+
+       preferred_availability = array(1440) that represents the # of preferred drivers at each minute of the day 
+    """
+    rng = np.random.default_rng(rng)
+    avail = np.zeros(1440)
+    avail, diff, schedules = update_availability_arr(avail, generate_bundle(chunk_size, rng), preferred_availability, acceptable_overlap, show_progress)
+    print(f'Maximu Difference between # Drivers Available and Preferred Amount: {diff.min().round()}', end = ' ')
+    while diff.min() <= -tolerated_under_preferred:
+        avail, diff, s2 = update_availability_arr(avail, generate_bundle(chunk_size, rng), preferred_availability, acceptable_overlap, show_progress)
+        print(diff.min().round(), end = ' ')
+        schedules = np.append(schedules, s2, axis = 0)
+    print()
+    return schedules
+
+def generate_arrivals_per_zone(zone_hourly_arrivals = None, 
+                               zone_dropoff_frequencies = None, 
+                               zone_to_zone_times = None, 
+                               one_list = True,
+                               show_progress_bar = False,
+                               rng = None,
+                               dropoff_table = None):
+    """dropoff_table -> prebuilt AliasTable for zone_dropoff_frequencies (built here if not given)"""
+    rng = np.random.default_rng(rng)
+
+    #fall back to the memoized input data
+    if zone_hourly_arrivals is None:
+        zone_hourly_arrivals = load_hourly_arrival_rate()
+    if zone_dropoff_frequencies is None:
+        zone_dropoff_frequencies = load_dropoff_frequency()
+        dropoff_table = load_dropoff_alias_table()
+    elif dropoff_table is None:
+        dropoff_table = dropoff_alias_table(zone_dropoff_frequencies)
+    if zone_to_zone_times is None:
+        zone_to_zone_times = load_trip_time_data()
+
+    #check to make sure the indices match
+    assert (zone_hourly_arrivals.index == zone_dropoff_frequencies.index).all()
+    
+    arrival_times = []
+    arrival_rows = []
+    #for each zone, generate a day's worth of arrivals
+    iterable = zone_hourly_arrivals.index if not show_progress_bar else tqdm(zone_hourly_arrivals.index, position = 0, leave = True, desc = 'Zone Arrivals Generated')
+    for row, i in enumerate(iterable):
+        
+        hourly_rates = zone_hourly_arrivals.loc[i]
+                
+        max_rate = hourly_rates.max()
+        #rate = max_rate / 60 minutes (since max_rate is in minutes)
+        #input the inverse as the mean interarrival time (scale parameter for rng.exponential)
+        temp_interarrivals = rng.exponential(scale = 60/max_rate, size = 25000)
+        while temp_interarrivals.cumsum().max() <= 24 * 60:
+            temp_interarrivals = np.append(temp_interarrivals, rng.exponential(scale = 60/max_rate, size = 25000))
+        
+        #this cuts off interarrivals at 1 day
+        interarrivals = temp_interarrivals[temp_interarrivals.cumsum() <= 24*60]
+        arrivals = interarrivals.cumsum()
+                
+        #thinning process
+        #uses constant hourly rate (like a 24 part step function) to generate the thinning probabilities
+        keep_probability = (hourly_rates[(arrivals // 60).astype(int)] / max_rate).values
+        unif = rng.uniform(size = arrivals.shape[0])
+        kept_arrivals = arrivals[unif <= keep_probability]
+
+        arrival_times.append(kept_arrivals)
+        arrival_rows.append(np.full(kept_arrivals.shape[0], row))
+
+    arrival_times = np.concatenate(arrival_times)
+    arrival_rows = np.concatenate(arrival_rows)
+    pickups = zone_hourly_arrivals.index.values[arrival_rows]
+
+    #for every arrival of the day generate from its zone's dropoff distribution at once
+    dropoffs = dropoff_table.sample(arrival_rows, rng)
+
+    #each arrival, generate a service time from the service time distribution of its (pickup, dropoff) pair
+    od_zone_ids = np.sort(zone_to_zone_times.index.get_level_values(0).unique().values)
+    od_stats = od_stats_array(zone_to_zone_times, od_zone_ids)
+    pair_stats = od_stats[np.searchsorted(od_zone_ids, pickups), np.searchsorted(od_zone_ids, dropoffs)]
+    services = np.maximum(rng.normal(loc = pair_stats[:, 0], scale = pair_stats[:, 1]), 0)
+
+    #generate data in the form of (time, dropoff location id, pickup location id, service)
+    arrival_data = np.vstack([arrival_times, dropoffs, pickups, services]).T
+    zone_arrivals = pd.DataFrame(data = arrival_data, columns = ['time','dolocationid','pulocationid','service'])
+    
+    #if one list, then combine everything into one big arrival matrix
+    #otherwise, just return the list of arrival dataframes
+    if one_list:
+        zone_arrivals = zone_arrivals.sort_values('time').reset_index(drop=True)
+    else:
+        zone_arrivals = [df.reset_index(drop=True) for _, df in zone_arrivals.groupby('pulocationid', sort = False)]
+    
+    return zone_arrivals
+
+def create_drivers(preferred_driver_availability, zone_ids, pickup_data, supply_rng):
+    """Drivers with schedules following the preferred availability, starting in zones proportionally to the pickups"""
+    #generate driver schedules
+    dschedules = generate_driver_schedules(preferred_driver_availability, rng = supply_rng)
+    driver_count = len(dschedules)
+    drivers = []
+
+    pbar = tqdm(total = driver_count, position = 0, leave = True, desc = 'Driver Objects Created')
+    #number of drivers per zone
+    #use the pickup data to do this
+    arrivals_per_zone = pickup_data.sum(axis=1)
+    dcounts = np.floor(driver_count * (arrivals_per_zone / arrivals_per_zone.sum()))
+    
+    driver_index = 0
+    for i in dcounts.index:
+        for j in range(int(dcounts.loc[i])):
+            d = Driver(i, dschedules[driver_index][0], dschedules[driver_index][1], driver_id = driver_index)
+            drivers.append(d)
+            pbar.update(1)
+            driver_index += 1
+    
+    for i in range(driver_count - len(drivers)):
+        z = supply_rng.choice(zone_ids)
+        d = Driver(z, dschedules[driver_index][0], dschedules[driver_index][1], driver_id = driver_index)
+        drivers.append(d)
+        pbar.update(1)
+        driver_index += 1
+    return drivers
+
+def with_zone_geometry(city_options, odmatrix, zone_ids):
+    """city_options with the zone geometry tables added, unless they're given (or turned off) already or odmatrix isn't
+       the trip time data the tables were fitted to (ex. a synthetic city)
+    """
+    city_options = dict(city_options or {})
+    if 'geometry' not in city_options:
+        fingerprint = zone_geometry.od_fingerprint(od_stats_array(odmatrix, zone_ids))
+        #other OD matrices never need the tables, so they aren't even built for them
+        if fingerprint == load_od_fingerprint():
+            geometry, metadata = load_zone_geometry()
+            if metadata['od_fingerprint'] == fingerprint:
+                city_options['geometry'] = geometry
+    return city_options
+
+def simulate_with_individual_drivers(arrivals,
+                                     preferred_driver_availability,
+                                     driver_distribution = 'proportional',
+                                     odmatrix = None,
+                                     pickup_data = None,
+                                     supply_rng = None,
+                                     travel_rng = None,
+                                     city_options = None,
+                                     observer = None,
+                                     profiler = None):
+    """supply_rng drives the driver schedules and starting zones, travel_rng the movement times inside the city
+       city_options = extra keyword arguments for City (ex. {'dispatch_window': 0.25} for batched dispatch),
+                      the zone geometry tables are used for missing OD pairs of the real trip time data unless it has
+                      {'geometry': None}
+       observer = optional function called as observer(event, result, city) after every event (ex. live.LivePublisher)
+       profiler = optional memory_profile.MemoryProfiler, records the schedule generation and event loop phases
+    """
+    supply_rng = np.random.default_rng(supply_rng)
+    if odmatrix is None:
+        odmatrix = load_trip_time_data()
+    if pickup_data is None:
+        pickup_data = load_hourly_arrival_rate()
+
+    #convert arrivals into the passenger table, and then into events that refer to passengers by row
+    passengers = PassengerTable(arrivals.values)
+    drivers = []
+    
+    initial_events = deque()
+    for passenger_id, arrival_time in enumerate(tqdm(passengers.time.tolist(), position = 0, leave = True, desc = 'Arrival Events Created')):
+        initial_events.append(Arrival(arrival_time, passenger_id))
+    
+    #setup drivers and zones based on driver_distribution parameter
+    #setup driver schedules and insert driver arrivals and departures into the initial event list 
+    #everything is under the city class
+    if driver_distribution == 'proportional':
+
+        zone_ids = np.sort(odmatrix.index.get_level_values(0).unique())
+        with profile_phase(profiler, 'schedule generation'):
+            drivers = create_drivers(preferred_driver_availability, zone_ids, pickup_data, supply_rng)
+        for d in drivers:
+            #also want to add the driver departure and arrival to the initial event list
+            initial_events.append(DriverArrival(d))
+            initial_events.append(DriverDeparture(d))
+                    
+        city = City('NYC', zone_ids, drivers, odmatrix, passengers, rng = travel_rng, **with_zone_geometry(city_options, odmatrix, zone_ids))
+
+    event_list = EventList(initial_events)
+            
+    #iterate through the event list until no events left
+    pbar = tqdm(total = arrivals.shape[0], position = 0, leave = True, desc = 'Passengers Processed')
+    with profile_phase(profiler, 'event loop'):
+        while not event_list.is_finished():
+            
+            event = event_list.iterate_next_event()
+
+            result = city.process_event(event)
+            if event.type == 'Trip':
+                pbar.update(1)
+            if observer is not None:
+                observer(event, result, city)
+
+            #batched dispatch can start several movements at once
+            if isinstance(result, list):
+                for r in result:
+                    event_list.insert_event(r)
+            elif result is not None:
+                event_list.insert_event(result)    
+                
+    return passengers, drivers, city, event_list
+
+def simulate_replication(i,
+                         preferred_availability,
+                         driver_distribution = 'proportional',
+                         seed = None,
+                         inputs = None,
+                         city_options = None,
+                         observer = None,
+                         profiler = None):
+    """Simulates day i of a run with root seed seed, returns (passenger dataframe, drivers, city, event list)
+
+       inputs = optional dictionary overriding the memoized input data, with keys hourly_arrival_rate, dropoff_frequency,
+                trip_time_data and (optionally) dropoff_table
+       observer, profiler = see simulate_with_individual_drivers
+    """
+    inputs = inputs or {}
+    print(f'--- Day {i} ---')
+    if profiler is not None:
+        profiler.replication = i
+    streams = replication_streams(seed, i)
+    with profile_phase(profiler, 'arrival generation'):
+        arrivals = generate_arrivals_per_zone(inputs.get('hourly_arrival_rate'),
+                                              inputs.get('dropoff_frequency'),
+                                              inputs.get('trip_time_data'),
+                                              show_progress_bar=True,
+                                              rng = streams['demand'],
+                                              dropoff_table = inputs.get('dropoff_table'))
+    p, d, c, e = simulate_with_individual_drivers(arrivals, 
+                                                  driver_distribution = driver_distribution, 
+                                                  preferred_driver_availability=preferred_availability,
+                                                  odmatrix = inputs.get('trip_time_data'),
+                                                  pickup_data = inputs.get('hourly_arrival_rate'),
+                                                  supply_rng = streams['supply'],
+                                                  travel_rng = streams['travel'],
+                                                  city_options = city_options,
+                                                  observer = observer,
+                                                  profiler = profiler)
+    with profile_phase(profiler, 'export'):
+        waiting_times = p.return_passenger_dataframe()
+        waiting_times['arrival_hour'] = waiting_times.arrival_time//60
+        waiting_times['replication'] = i
+    
+    print(f'Average Waiting Time: {waiting_times.waiting_time.mean()}')
+    print(f'Median Waiting Time: {np.median(waiting_times.waiting_time)}')
+    print(f'Simulation System Speed: {e.formatted_stats()} \nMore stats: {c.formatted_stats()} \n --- End of Day {i} ---\n')
+    return waiting_times, d, c, e
+
+def waiting_time_summary(waiting_times):
+    """count, mean, median and standard deviation of the waiting time per (replication, arrival hour)"""
+    return waiting_times.groupby(['replication', 'arrival_hour']).waiting_time.agg(['count', 'mean', 'median', 'std']).reset_index()
+
+def simulate_n_days(n,
+                    preferred_availability,
+                    driver_distribution = 'proportional',
+                    seed = None,
+                    city_options = None,
+                    profiler = None,
+                    memory_budget = None,
+                    spill_dir = None,
+                    budget_fraction = 0.8):
+    """seed -> root seed of the run, replication i always uses replication_streams(seed, i)
+       so any replication can be rerun on its own, and runs of different policies with the same seed share common random numbers
+
+       profiler -> optional memory_profile.MemoryProfiler, its report is printed after every replication
+       memory_budget -> optional limit on the process RSS in MB, checked at the end of every phase of every replication
+                        (see memory_profile). Once the RSS gets past budget_fraction of it, the passenger details are
+                        written to parquet files in spill_dir (and spill_dir is returned instead of a dataframe), or without
+                        a spill_dir only the waiting_time_summary of every replication is kept (and returned).
+                        The last driver and city histories aren't kept either once the budget is hit
+    """
+    #just keep 1 driver history bc it takes up too much memory
+    #keep all the waiting time information in dataframes
+    passenger_details = []
+    driver_history = None
+    city_history = None
+    #'full' keeps every passenger, 'spill' writes them to spill_dir and 'summary' only keeps waiting_time_summary rows
+    output_mode = 'full'
+
+    def apply_budget(record = None):
+        #also runs in the middle of a replication, so the passengers of the finished ones leave memory before it grows more
+        nonlocal output_mode, passenger_details, driver_history, city_history
+        if output_mode == 'full' and rss_bytes() > budget_fraction * memory_budget * MB:
+            output_mode = 'spill' if spill_dir is not None else 'summary'
+            driver_history, city_history = None, None
+            print(f'RSS of {rss_bytes() / MB:.0f} MB is close to the memory budget of {memory_budget} MB, switching to {output_mode} output')
+            if output_mode == 'spill':
+                os.makedirs(spill_dir, exist_ok = True)
+
+        if output_mode == 'spill':
+            for df in passenger_details:
+                df.to_parquet(os.path.join(spill_dir, f'replication-{df.replication.iloc[0]}.parquet'))
+            passenger_details = []
+        elif output_mode == 'summary':
+            passenger_details = [df if 'waiting_time' not in df.columns else waiting_time_summary(df) for df in passenger_details]
+
+    #the budget is checked at the phase boundaries of the profiler, a profiler that isn't given only samples the RSS
+    report = profiler is not None
+    if memory_budget is not None:
+        profiler = profiler if report else MemoryProfiler(trace = False)
+        profiler.on_phase_end = apply_budget
+
+    seed = np.random.SeedSequence(seed).entropy
+    print(f'Seed: {seed}')
+    
+    try:
+        for i in range(n):
+            waiting_times, d, c, e = simulate_replication(i, preferred_availability, driver_distribution, seed, city_options = city_options, profiler = profiler)
+            passenger_details.append(waiting_times)
+            
+            if i == n - 1 and output_mode == 'full':
+                driver_history = d
+                city_history = c
+            #don't hold on to this replication's drivers and city while the next one runs
+            del d, c, e, waiting_times
+
+            if memory_budget is not None:
+                apply_budget()
+
+            if report:
+                print(profiler.format_replication(i))
+    finally:
+        if memory_budget is not None:
+            profiler.on_phase_end = None
+    
+    if output_mode == 'spill':
+        return spill_dir, driver_history, city_history
+    return pd.concat(passenger_details), driver_history, city_history
+
+def replication_kpis(waiting_times, kpis = ('mean', 'median'), by_hour = False):
+    """Series of the waiting time kpis of one replication, indexed by kpi (and arrival hour if by_hour)"""
+    if by_hour:
+        return waiting_times.groupby('arrival_hour').waiting_time.agg(list(kpis)).stack()
+    return waiting_times.waiting_time.agg(list(kpis))
+
+def confidence_half_widths(kpi_history, confidence = 0.95):
+    """Half width of the t confidence interval of every kpi, kpi_history = dataframe with one row per replication"""
+    #scipy takes longer to import than the rest of the simulator, so only pay for it when it's used
+    import scipy.stats as stats
+    n = kpi_history.count()
+    t = stats.t.ppf(1 - (1 - confidence) / 2, np.maximum(n - 1, 1))
+    return t * kpi_history.std() / np.sqrt(n)
+
+"""Precision -> the largest confidence interval half width (in minutes, or as a fraction of the estimate if relative) 
+accepted for every kpi
+
+Kpis -> waiting time statistics computed per replication (anything pandas' agg accepts, ex. 'mean', 'median')
+
+By_hour -> the precision has to hold for the kpis of every arrival hour instead of the whole day
+
+Min_replications/max_replications -> replications always run before checking / budget of replications
+"""
+def simulate_until_precise(preferred_availability,
+                           precision,
+                           kpis = ('mean', 'median'),
+                           by_hour = False,
+                           relative = False,
+                           confidence = 0.95,
+                           min_replications = 3,
+                           max_replications = 30,
+                           driver_distribution = 'proportional',
+                           seed = None,
+                           city_options = None):
+    """Sequential version of simulate_n_days, keeps adding replications until the confidence intervals
+       of the kpis are narrow enough or the budget runs out
+
+       returns the same as simulate_n_days plus a report with the # of replications used
+    """
+    passenger_details = []
+    kpi_history = []
+    driver_history = None
+    city_history = None
+
+    seed = np.random.SeedSequence(seed).entropy
+    print(f'Seed: {seed}')
+
+    converged = False
+    for i in range(max_replications):
+        waiting_times, driver_history, city_history, e = simulate_replication(i, preferred_availability, driver_distribution, seed, city_options = city_options)
+        passenger_details.append(waiting_times)
+        kpi_history.append(replication_kpis(waiting_times, kpis, by_hour))
+
+        if i + 1 >= max(min_replications, 2):
+            history = pd.DataFrame(kpi_history)
+            half_widths = confidence_half_widths(history, confidence)
+            tolerance = precision * history.mean().abs() if relative else precision
+            widest = (half_widths / tolerance).max()
+            print(f'Replications: {i + 1}, widest confidence interval: {widest:.2f}x the requested precision')
+            if (half_widths <= tolerance).all():
+                converged = True
+                break
+
+    history = pd.DataFrame(kpi_history)
+    report = {'replications': len(kpi_history),
+              'converged': converged,
+              'estimates': history.mean(),
+              'half_widths': confidence_half_widths(history, confidence)}
+    print(f"Used {report['replications']} replications ({'converged' if converged else 'budget reached before the requested precision'})")
+    
+    return pd.concat(passenger_details), driver_history, city_history, report
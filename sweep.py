@@ -0,0 +1,146 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from multiprocessing import Pool, shared_memory
+from contextlib import redirect_stdout, redirect_stderr
+from simulation import *
+import os
+import sys
+
+"""Parameter sweeps over driver availability curves (the preferred_availability of simulate_n_days)
+
+The inputs (arrival rates, dropoff distributions, OD matrix) and every scenario's availability curve are loaded once by
+the parent process and put in multiprocessing.shared_memory. A pool of workers maps those blocks as numpy arrays and
+runs (scenario, replication) tasks, so no worker reads or unpickles the input files.
+
+Every replication's passengers are written to one hive partitioned parquet dataset (output_dir/passengers/scenario=.../),
+which analysis.open_sweep reads back. All scenarios share the seed, so replication i of every scenario sees the same
+arrivals (common random numbers)
+"""
+
+def scaled_availability(curve, fleet_size):
+    """Rescales an availability curve (ex. the minimum active trips curve) so that its peak is fleet_size"""
+    curve = np.asarray(curve, dtype = float)
+    return curve / curve.max() * fleet_size
+
+class SharedArrays:
+    """Numpy arrays copied into shared memory blocks, described by a picklable manifest for the workers"""
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.manifest = {}
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            block = shared_memory.SharedMemory(create = True, size = max(a.nbytes, 1))
+            np.ndarray(a.shape, dtype = a.dtype, buffer = block.buf)[...] = a
+            self.blocks.append(block)
+            self.manifest[name] = (block.name, a.dtype.str, a.shape)
+
+    def release(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+def attach_shared_arrays(manifest):
+    """Maps the blocks of a SharedArrays manifest, returns (dictionary of arrays, blocks to keep alive)"""
+    arrays = {}
+    blocks = []
+    for name, (block_name, dtype, shape) in manifest.items():
+        #pool workers share the parent's resource tracker, so the blocks stay alive until the parent unlinks them
+        block = shared_memory.SharedMemory(name = block_name)
+        arrays[name] = np.ndarray(shape, dtype = np.dtype(dtype), buffer = block.buf)
+        blocks.append(block)
+    return arrays, blocks
+
+#state of a worker process, set once by initialize_worker
+worker = {}
+
+def initialize_worker(manifest, scenario_names, output_dir, seed):
+    arrays, blocks = attach_shared_arrays(manifest)
+    hourly_arrival_rate = hourly_arrival_rate_frame(arrays)
+    dropoff_frequency = dropoff_frequency_frame(arrays)
+    worker.update({'blocks': blocks,
+                   'availability': arrays['availability'],
+                   'scenario_names': scenario_names,
+                   'output_dir': output_dir,
+                   'seed': seed,
+                   'inputs': {'hourly_arrival_rate': hourly_arrival_rate,
+                              'dropoff_frequency': dropoff_frequency,
+                              'trip_time_data': trip_time_frame(arrays),
+                              'dropoff_table': dropoff_alias_table(dropoff_frequency)}})
+
+def run_task(task):
+    """Runs one replication of one scenario and writes its passengers to the partitioned dataset"""
+    scenario_index, replication = task
+    scenario = worker['scenario_names'][scenario_index]
+    log_file = os.path.join(worker['output_dir'], 'logs', f'{scenario}_{replication}.txt')
+    with open(log_file, 'w') as log, redirect_stdout(log), redirect_stderr(log):
+        waiting_times, d, c, e = simulate_replication(replication,
+                                                      worker['availability'][scenario_index],
+                                                      seed = worker['seed'],
+                                                      inputs = worker['inputs'])
+
+    waiting_times['scenario'] = scenario
+    ds.write_dataset(pa.Table.from_pandas(waiting_times, preserve_index = False),
+                     os.path.join(worker['output_dir'], 'passengers'),
+                     format = 'parquet',
+                     partitioning = ds.partitioning(pa.schema([('scenario', pa.string())]), flavor = 'hive'),
+                     basename_template = f'replication-{replication}-{{i}}.parquet',
+                     existing_data_behavior = 'overwrite_or_ignore')
+
+    return {'scenario': scenario,
+            'replication': replication,
+            'passengers': len(waiting_times),
+            'mean_waiting_time': waiting_times.waiting_time.mean(),
+            'median_waiting_time': waiting_times.waiting_time.median()}
+
+"""Scenarios -> dictionary of scenario name: preferred availability (a constant # of drivers or an array(1440))
+
+Replications -> # of replications per scenario
+
+Processes -> size of the worker pool (defaults to the # of cpus)
+
+Inputs -> optional dictionary of hourly_arrival_rate, dropoff_frequency, trip_time_data dataframes to use instead of input_data/
+"""
+def run_sweep(scenarios, replications, output_dir, processes = None, seed = None, inputs = None):
+    """Runs every (scenario, replication) pair over a worker pool, returns a dataframe with one summary row per task"""
+    os.makedirs(os.path.join(output_dir, 'logs'), exist_ok = True)
+    seed = np.random.SeedSequence(seed).entropy
+    print(f'Seed: {seed}')
+
+    scenario_names = list(scenarios)
+    availability = np.array([np.broadcast_to(np.asarray(scenarios[name], dtype = float), 1440) for name in scenario_names])
+
+    if inputs is not None:
+        zone_ids = np.sort(inputs['trip_time_data'].index.get_level_values(0).unique().values)
+        arrays = dense_input_arrays(inputs['hourly_arrival_rate'], inputs['dropoff_frequency'], inputs['trip_time_data'], zone_ids)
+    elif load_input_bundle() is not None:
+        arrays = load_input_bundle()
+    else:
+        arrays = dense_input_arrays(load_hourly_arrival_rate(), load_dropoff_frequency(), load_trip_time_data())
+    arrays = {name: arrays[name] for name in ['zone_ids', 'hourly_rates', 'has_pickup_data', 'dropoff_probabilities', 'od_stats']}
+    arrays['availability'] = availability
+
+    shared = SharedArrays(arrays)
+    tasks = [(s, r) for r in range(replications) for s in range(len(scenario_names))]
+    try:
+        with Pool(processes, initializer = initialize_worker, initargs = (shared.manifest, scenario_names, output_dir, seed)) as pool:
+            summaries = list(tqdm(pool.imap_unordered(run_task, tasks), total = len(tasks), position = 0, leave = True, desc = 'Replications Finished'))
+    finally:
+        shared.release()
+
+    summary = pd.DataFrame(summaries).sort_values(['scenario', 'replication']).reset_index(drop = True)
+    summary.to_csv(os.path.join(output_dir, 'summary.csv'), index = False)
+    return summary
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print("usage: python3 sweep.py {# REPLICATIONS} {OUTPUT DIRECTORY} {FLEET SIZE} [{FLEET SIZE} ...]")
+        sys.exit(1)
+    replications = int(sys.argv[1])
+    output_dir = os.path.join('output', sys.argv[2])
+    #constant availability scenarios named like the existing output folders (12000 -> d12k)
+    scenarios = {f'd{int(size) // 1000}k' if int(size) % 1000 == 0 else f'd{size}': int(size) for size in sys.argv[3:]}
+    summary = run_sweep(scenarios, replications, output_dir)
+    print(summary.groupby('scenario')[['mean_waiting_time', 'median_waiting_time']].agg(['mean', 'var']))
@@ -0,0 +1,174 @@
+import pandas as pd
+import numpy as np
+from joblib import load
+import os
+import sys
+import hashlib
+from input_bundle import *
+
+"""Zone geometry tables computed once from the cached zone polygons (viz/polygon_info, no network access needed)
+
+Stored in the input bundle format (python3 zone_geometry.py writes input_data/zone_geometry), every table is indexed
+by zone_id - 1:
+
+    centroids = array(263, 2) area weighted centroid of every zone in screen pixels
+    distances = array(263, 263) distance between zone centroids (pixels, with the y axis rescaled, see below)
+    adjacency = array(263, 263) whether two zones share a border (up to a gap of a couple of pixels)
+    neighbors = array(263, 262) the other zone ids of every zone, closest centroid first
+    fallback_times = array(263, 263) estimated mean movement time for every pair of zones
+    closest_zones = array(263, 262) the other zone ids of every zone by mean movement time, the OD mean where there is
+                    one and fallback_times otherwise (City's dispatch neighbours)
+
+The file is generated, not checked in: load_zone_geometry builds it the first time it's needed and rebuilds it
+whenever polygon_info or trip_time_means is newer than it. The metadata holds the od_fingerprint of the trip times
+the tables were fitted to, the simulation only uses them for an OD matrix with the same fingerprint
+
+The screen projection doesn't keep the aspect ratio of the map, so the y axis is rescaled by the factor that makes
+centroid distances fit the observed OD mean times best. fallback_times is intercept + slope * distance from a
+least squares fit on the observed pairs (weighted by their trip counts), for a zone to itself the distance used is the
+mean distance from a point of the zone to its centroid
+"""
+
+POLYGON_INFO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'viz', 'polygon_info')
+DEFAULT_GEOMETRY_PATH = os.path.join(INPUT_DIR, 'zone_geometry')
+SCREEN_SIZE = (1200, 800)
+
+#movement times are never estimated below this (minutes)
+MIN_FALLBACK_TIME = 1.0
+#bumped whenever the tables change, older files are rebuilt
+GEOMETRY_VERSION = 2
+
+def rasterize_zones(xy_pixel_polygons, size = SCREEN_SIZE):
+    """array(height, width) with the zone id covering every pixel (0 for no zone)"""
+    #matplotlib is only needed to build the tables, not to load them
+    from matplotlib.path import Path
+    width, height = size
+    labels = np.zeros((height, width), dtype = np.int16)
+    for coords, zone in xy_pixel_polygons:
+        lo = np.clip(np.floor(coords.min(axis = 0)).astype(int), 0, None)
+        hi = np.minimum(np.ceil(coords.max(axis = 0)).astype(int), [width - 1, height - 1])
+        xs, ys = np.meshgrid(np.arange(lo[0], hi[0] + 1), np.arange(lo[1], hi[1] + 1))
+        #test the pixel centers
+        inside = Path(coords).contains_points(np.column_stack([xs.ravel(), ys.ravel()]) + 0.5)
+        labels[ys.ravel()[inside], xs.ravel()[inside]] = zone
+    return labels
+
+def zone_centroids(labels, xy_pixel_polygons, zone_ids = ZONE_IDS):
+    """array(zones, 2) mean pixel position of every zone, zones too small to cover a pixel use the mean of their vertices"""
+    ys, xs = np.nonzero(labels)
+    zones = labels[ys, xs]
+    size = zone_ids.max() + 1
+    counts = np.bincount(zones, minlength = size)
+    centroids = np.column_stack([np.bincount(zones, weights = xs + 0.5, minlength = size),
+                                 np.bincount(zones, weights = ys + 0.5, minlength = size)])
+    centroids = np.divide(centroids, counts[:, None], out = np.full(centroids.shape, np.nan), where = counts[:, None] > 0)
+    for coords, zone in xy_pixel_polygons:
+        if counts[zone] == 0:
+            centroids[zone] = coords.mean(axis = 0)
+    return centroids[zone_ids], counts[zone_ids]
+
+def adjacency_matrix(labels, zone_ids = ZONE_IDS, gap = 2):
+    """array(zones, zones) of zones with pixels within gap pixels of each other (polygons are rounded to whole pixels,
+       so neighbouring zones don't always touch exactly)
+    """
+    height, width = labels.shape
+    size = zone_ids.max() + 1
+    adjacent = np.zeros((size, size), dtype = bool)
+    for dy in range(gap + 1):
+        for dx in range(-gap, gap + 1):
+            if (dy == 0 and dx <= 0) or dx * dx + dy * dy > gap * gap:
+                continue
+            a = labels[:height - dy, max(0, -dx):width - max(0, dx)]
+            b = labels[dy:, max(0, dx):width - max(0, -dx)]
+            touching = (a != b) & (a > 0) & (b > 0)
+            adjacent[a[touching], b[touching]] = True
+    adjacent |= adjacent.T
+    return adjacent[np.ix_(zone_ids, zone_ids)]
+
+def centroid_distances(centroids, y_scale = 1.0):
+    delta = centroids[:, None, :] - centroids[None, :, :]
+    return np.sqrt(delta[:, :, 0] ** 2 + (y_scale * delta[:, :, 1]) ** 2)
+
+def od_fingerprint(od_stats):
+    """Hash of a dense OD stats array (input_bundle.od_stats_array), identifies the trip times the tables were fitted to"""
+    return hashlib.sha1(np.ascontiguousarray(od_stats, dtype = np.float64).tobytes()).hexdigest()
+
+def ranked_zones(times, zone_ids = ZONE_IDS):
+    """array(zones, zones - 1) of the other zone ids of every zone, smallest time first (ties keep the zone order)"""
+    order = zone_ids[np.argsort(times, axis = 1, kind = 'stable')]
+    #a zone isn't always first in its own row, so it's dropped by id
+    return order[order != zone_ids[:, None]].reshape((len(zone_ids), len(zone_ids) - 1))
+
+def fit_travel_times(centroids, od_stats, y_scales = np.linspace(0.5, 2.5, 81)):
+    """Weighted least squares of the observed mean time between two different zones on their centroid distance
+       Returns (y_scale, intercept, slope, r2) for the y axis scale that fits best
+    """
+    means, counts = od_stats[:, :, 0], od_stats[:, :, 4]
+    observed = (counts > 0) & ~np.eye(len(centroids), dtype = bool)
+    y, w = means[observed], counts[observed]
+    y_bar = np.average(y, weights = w)
+    best = None
+    for y_scale in y_scales:
+        x = centroid_distances(centroids, y_scale)[observed]
+        x_bar = np.average(x, weights = w)
+        slope = np.sum(w * (x - x_bar) * (y - y_bar)) / np.sum(w * (x - x_bar) ** 2)
+        intercept = y_bar - slope * x_bar
+        r2 = 1 - np.sum(w * (y - intercept - slope * x) ** 2) / np.sum(w * (y - y_bar) ** 2)
+        if best is None or r2 > best[3]:
+            best = (float(y_scale), float(intercept), float(slope), float(r2))
+    return best
+
+def compile_zone_geometry(file_name = DEFAULT_GEOMETRY_PATH, polygon_file = POLYGON_INFO_PATH, input_dir = INPUT_DIR):
+    xy_pixel_polygons, zone_dict = load(polygon_file)
+    labels = rasterize_zones(xy_pixel_polygons)
+    centroids, pixel_counts = zone_centroids(labels, xy_pixel_polygons)
+
+    trip_time_data = pd.read_parquet(os.path.join(input_dir, 'trip_time_means'))
+    od_stats = od_stats_array(trip_time_data, ZONE_IDS)
+    y_scale, intercept, slope, r2 = fit_travel_times(centroids, od_stats)
+
+    distances = centroid_distances(centroids, y_scale)
+    #the mean distance from a point of a disc to its center is 2/3 of the radius
+    radius = np.sqrt(y_scale * np.maximum(pixel_counts, 1) / np.pi)
+    np.fill_diagonal(distances, 2 * radius / 3)
+    fallback_times = np.maximum(intercept + slope * distances, MIN_FALLBACK_TIME).astype(np.float32)
+    #same rule as City: a pair without any OD stats uses the fallback time
+    mean_times = np.where((od_stats == 0).all(axis = 2), fallback_times.astype(float), od_stats[:, :, 0])
+
+    arrays = {'zone_ids': ZONE_IDS.astype(np.int64),
+              'centroids': centroids,
+              'distances': distances.astype(np.float32),
+              'adjacency': adjacency_matrix(labels),
+              'neighbors': ranked_zones(distances).astype(np.int16),
+              'fallback_times': fallback_times,
+              'closest_zones': ranked_zones(mean_times).astype(np.int16)}
+    #write next to the file and swap it in, so processes building it at the same time never read half a file
+    temp_file_name = f'{file_name}.{os.getpid()}.tmp'
+    write_bundle(temp_file_name, arrays, metadata = {'y_scale': y_scale, 'intercept': intercept, 'slope': slope, 'r2': r2,
+                                                     'od_fingerprint': od_fingerprint(od_stats),
+                                                     'geometry_version': GEOMETRY_VERSION,
+                                                     'sources': [os.path.basename(polygon_file), 'trip_time_means']})
+    os.replace(temp_file_name, file_name)
+    return arrays, {'y_scale': y_scale, 'intercept': intercept, 'slope': slope, 'r2': r2}
+
+def geometry_is_current(file_name = DEFAULT_GEOMETRY_PATH, polygon_file = POLYGON_INFO_PATH, input_dir = INPUT_DIR):
+    """The tables are only used if they exist, have the current layout and are newer than the polygons and the trip
+       times they were fitted to
+    """
+    if not os.path.exists(file_name) or read_bundle(file_name)[1].get('geometry_version') != GEOMETRY_VERSION:
+        return False
+    geometry_time = os.path.getmtime(file_name)
+    return all(os.path.getmtime(s) <= geometry_time
+               for s in [polygon_file, os.path.join(input_dir, 'trip_time_means')] if os.path.exists(s))
+
+def load_zone_geometry(file_name = DEFAULT_GEOMETRY_PATH):
+    """Memory maps the tables, (re)building them first if they're missing or out of date, returns (arrays, metadata)"""
+    if not geometry_is_current(file_name):
+        print(f'Building the zone geometry tables in {file_name}')
+        compile_zone_geometry(file_name)
+    return read_bundle(file_name)
+
+if __name__ == '__main__':
+    output_file_name = sys.argv[1] if len(sys.argv) == 2 else DEFAULT_GEOMETRY_PATH
+    arrays, fit = compile_zone_geometry(output_file_name)
+    print(f"Zone geometry written to {output_file_name} (time = {fit['intercept']:.2f} + {fit['slope']:.4f} * distance, R^2 = {fit['r2']:.3f})")